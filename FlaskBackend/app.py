@@ -1,9 +1,10 @@
 import nltk
 import os
 import logging
-from flask import Flask, request, jsonify, send_file
+from flask import Flask, request, jsonify, send_file, Response, stream_with_context
 from flask_cors import CORS
 from google.cloud import texttospeech
+from google.cloud import texttospeech_v1beta1  # Needed for SSML mark timepoints
 from google.api_core import exceptions
 import io
 from dotenv import load_dotenv
@@ -14,13 +15,33 @@ from nltk.chunk import RegexpParser  # For improved phrase extraction
 from heapq import nlargest
 import string
 import re
-from collections import Counter
+from collections import Counter, OrderedDict, defaultdict, namedtuple
 import traceback
 import google.generativeai as genai
 import json
+import hashlib
+import sqlite3
+import threading
+import time
+import asyncio
+import base64
+import struct
+import math
+import tempfile
+import textwrap
+import uuid
+import zlib
+import click
+from xml.sax.saxutils import escape as xml_escape
+from concurrent.futures import Future, ThreadPoolExecutor, wait, FIRST_COMPLETED, TimeoutError as FutureTimeoutError
 from flask_limiter import Limiter  # For rate limiting
 from flask_limiter.util import get_remote_address
 
+try:
+    import numpy as np  # Only needed to derive speed variants locally
+except ImportError:
+    np = None
+
 # --- Configuration and Initialization (Same as previous, with additions) ---
 
 # Configure logging
@@ -46,12 +67,19 @@ limiter = Limiter(
 )
 
 # Initialize Gemini API (Prioritize)
+# Needs a model that supports schema-constrained JSON output (response_schema).
+# The gemini-1.5 models are retired: naming one (or any unserved model) fails
+# every call, and every summary then silently falls back to NLTK.
+GEMINI_MODEL = os.environ.get("GEMINI_MODEL", "gemini-2.5-flash")
+# Extra model calls allowed to fix output that fails validation before falling back to NLTK
+GEMINI_REPAIR_ATTEMPTS = int(os.environ.get("GEMINI_REPAIR_ATTEMPTS", 1))
 gemini_available = False
 gemini_model = None
+gemini_output_stats = Counter()
 if "GEMINI_API_KEY" in os.environ:
     genai.configure(api_key=os.environ["GEMINI_API_KEY"])
     try:
-        gemini_model = genai.GenerativeModel('gemini-pro')
+        gemini_model = genai.GenerativeModel(GEMINI_MODEL)
         gemini_available = True
         logger.info("Gemini API initialized successfully")
     except Exception as e:
@@ -70,6 +98,1158 @@ except Exception as e:
     logger.error(f"Failed to initialize Google Cloud TTS client: {str(e)}")
     client = None  # Ensure client is None if initialization fails
 
+# Timepoints are only exposed by the v1beta1 API
+try:
+    beta_client = texttospeech_v1beta1.TextToSpeechClient() if client is not None else None
+except Exception as e:
+    logger.error(f"Failed to initialize Google Cloud TTS v1beta1 client: {str(e)}")
+    beta_client = None
+
+
+# --- Async TTS Client ---
+
+TTS_ASYNC = os.environ.get("TTS_ASYNC", "False").lower() in ('true', '1', 't')
+# In-flight Google calls per process on the async client. Waiting calls hold no
+# thread, so this is far above TTS_MAX_WORKERS; it only protects the quota.
+TTS_ASYNC_MAX_IN_FLIGHT = int(os.environ.get("TTS_ASYNC_MAX_IN_FLIGHT", 256))
+
+
+class AsyncTTSRunner:
+    """Owns a TextToSpeechAsyncClient and the event loop it runs on.
+
+    One loop thread per worker process multiplexes every in-flight synthesis over
+    a single grpc.aio channel; callers get concurrent.futures.Future objects back.
+    """
+
+    def __init__(self):
+        self._slots = None
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._loop.run_forever, name='tts-async', daemon=True)
+        self._thread.start()
+        # grpc.aio channels bind to the loop they are created on
+        self.client = self.run(self._create_client()).result()
+
+    async def _create_client(self):
+        return texttospeech.TextToSpeechAsyncClient()
+
+    def run(self, coroutine):
+        """Schedule a coroutine on the runner's loop from any thread"""
+        return asyncio.run_coroutine_threadsafe(coroutine, self._loop)
+
+    async def synthesize(self, request):
+        """Call synthesize_speech, holding one of TTS_ASYNC_MAX_IN_FLIGHT slots"""
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(TTS_ASYNC_MAX_IN_FLIGHT)
+        async with self._slots:
+            return await self.client.synthesize_speech(request=request)
+
+    async def offload(self, fn, *args):
+        """Run blocking work (disk I/O) off the loop thread"""
+        return await self._loop.run_in_executor(None, fn, *args)
+
+
+# Created on first use in each process: a loop thread started at import would not
+# survive the fork into gunicorn workers under --preload
+async_tts = None
+async_tts_pid = None
+async_tts_lock = threading.Lock()
+
+
+def get_async_tts():
+    """This process's AsyncTTSRunner, or None when TTS_ASYNC is off or it failed to start."""
+    global async_tts, async_tts_pid
+    if not TTS_ASYNC or client is None:
+        return None
+    if async_tts_pid == os.getpid():
+        return async_tts
+    with async_tts_lock:
+        if async_tts_pid != os.getpid():
+            try:
+                async_tts = AsyncTTSRunner()
+                logger.info("Google Cloud TTS async client initialized successfully")
+            except Exception as e:
+                logger.error(f"Failed to initialize Google Cloud TTS async client, using the sync client: {str(e)}")
+                async_tts = None
+            async_tts_pid = os.getpid()
+    return async_tts
+
+
+# --- TTS Backends ---
+
+TTS_BACKEND = os.environ.get("TTS_BACKEND", "google").lower()
+# Used when the configured backend cannot start, e.g. no Google credentials
+TTS_FALLBACK_BACKEND = os.environ.get("TTS_FALLBACK_BACKEND", "local").lower()
+
+
+class TTSBackend:
+    """Interface the TTS endpoints dispatch through.
+
+    synthesize(params) returns (audio, meta), where meta carries the mark
+    timepoints when params.word_marks is set. list_voices() returns voices in
+    the /api/voices shape. encodings lists what the engine can produce, with
+    the preferred one first.
+    """
+
+    name = None
+    encodings = ('MP3', 'OGG_OPUS', 'LINEAR16')
+    supports_marks = False
+
+    def synthesize(self, params):
+        raise NotImplementedError
+
+    def list_voices(self):
+        raise NotImplementedError
+
+
+class GoogleTTSBackend(TTSBackend):
+    """Google Cloud Text-to-Speech."""
+
+    name = 'google'
+    supports_marks = True
+
+    def synthesize(self, params):
+        return synthesize_with_google(params)
+
+    def list_voices(self):
+        logger.info("Retrieving available voices from Google TTS API")
+        response = client.list_voices()
+        voices = []
+        for voice in response.voices:
+            if any(lang_code.startswith('en-') for lang_code in voice.language_codes):
+                if voice.ssml_gender == texttospeech.SsmlVoiceGender.MALE:
+                    gender = "Male"
+                elif voice.ssml_gender == texttospeech.SsmlVoiceGender.FEMALE:
+                    gender = "Female"
+                else:
+                    gender = "Neutral"
+
+                language_code = voice.language_codes[0]
+                voices.append({
+                    "id": voice.name,
+                    "name": voice.name.split('-')[-1],
+                    "accent": accent_for_language(language_code),
+                    "gender": gender,
+                    "language": language_code
+                })
+        return voices
+
+
+class SyntheticTTSBackend(TTSBackend):
+    """Deterministic stand-in that renders one tone per word as 16-bit PCM WAV.
+
+    Output depends only on the request, costs no quota and is fast enough to
+    load-test the serving path offline. Word marks are exact, since the
+    backend decides the timing itself.
+    """
+
+    name = 'synthetic'
+    encodings = ('LINEAR16',)
+    supports_marks = True
+    default_sample_rate = 16000
+
+    def synthesize(self, params):
+        sample_rate = params.sample_rate or self.default_sample_rate
+        gap = b'\x00\x00' * int(sample_rate * 0.05 / params.speed)
+        pcm = []
+        timepoints = []
+        offset = 0
+        for i, word in enumerate(params.text.split()):
+            timepoints.append({'name': f"w{i}", 'time': offset / sample_rate})
+            tone = self._tone(word, sample_rate, (0.08 + 0.06 * len(word)) / params.speed)
+            pcm.append(tone)
+            pcm.append(gap)
+            offset += (len(tone) + len(gap)) // 2
+        timepoints.append({'name': 'end', 'time': offset / sample_rate})
+
+        fmt = struct.pack('<HHIIHH', 1, 1, sample_rate, sample_rate * 2, 2, 16)
+        meta = {'timepoints': timepoints} if params.word_marks else {}
+        return build_wav(fmt, b''.join(pcm)), meta
+
+    def _tone(self, word, sample_rate, duration):
+        """A sine tone whose pitch is derived from the word, built from one repeated period"""
+        frequency = 200 + zlib.crc32(word.lower().encode('utf-8')) % 400
+        period = max(2, int(sample_rate / frequency))
+        cycle = struct.pack(
+            f'<{period}h',
+            *(int(8000 * math.sin(2 * math.pi * n / period)) for n in range(period))
+        )
+        samples = int(sample_rate * duration)
+        return (cycle * (samples // period + 1))[:samples * 2]
+
+    def list_voices(self):
+        return [
+            {"id": "en-US-Synthetic-A", "name": "A", "accent": "American", "gender": "Neutral", "language": "en-US"},
+            {"id": "en-GB-Synthetic-A", "name": "A", "accent": "British", "gender": "Neutral", "language": "en-GB"},
+        ]
+
+
+class LocalTTSBackend(TTSBackend):
+    """Offline speech through pyttsx3 (eSpeak, SAPI5 or NSSpeechSynthesizer).
+
+    pyttsx3 is optional and not thread-safe, so calls are serialized. Requested
+    voices are matched by language; the engine's default rate is scaled by speed.
+    """
+
+    name = 'local'
+    encodings = ('LINEAR16',)
+
+    def __init__(self):
+        import pyttsx3  # Optional dependency
+        self._engine = pyttsx3.init()
+        self._lock = threading.Lock()
+        self._base_rate = self._engine.getProperty('rate')
+        self._voices = {}
+        for index, voice in enumerate(self._engine.getProperty('voices')):
+            language = self._language_of(voice)
+            if language.startswith('en-'):
+                self._voices[f"{language}-Local-{index}"] = voice
+
+    def _language_of(self, voice):
+        for language in voice.languages or []:
+            if isinstance(language, bytes):
+                language = language.decode('utf-8', 'ignore').lstrip('\x05')
+            parts = str(language).replace('_', '-').split('-')
+            if len(parts) >= 2:
+                return f"{parts[0].lower()}-{parts[1].upper()}"
+        return 'en-US'
+
+    def _voice_for(self, params):
+        voice = self._voices.get(params.voice_id)
+        if voice is None:
+            for voice_id, candidate in self._voices.items():
+                if voice_id.startswith(params.language_code):
+                    return candidate
+            return next(iter(self._voices.values()), None)
+        return voice
+
+    def synthesize(self, params):
+        handle, path = tempfile.mkstemp(suffix='.wav')
+        os.close(handle)
+        try:
+            with self._lock:
+                voice = self._voice_for(params)
+                if voice is not None:
+                    self._engine.setProperty('voice', voice.id)
+                self._engine.setProperty('rate', int(self._base_rate * params.speed))
+                self._engine.save_to_file(params.text, path)
+                self._engine.runAndWait()
+            with open(path, 'rb') as f:
+                return f.read(), {}
+        finally:
+            os.remove(path)
+
+    def list_voices(self):
+        voices = []
+        for voice_id, voice in self._voices.items():
+            language = '-'.join(voice_id.split('-')[:2])
+            gender = (voice.gender or 'Neutral').title()
+            voices.append({
+                "id": voice_id,
+                "name": voice.name,
+                "accent": accent_for_language(language),
+                "gender": gender if gender in ('Male', 'Female') else 'Neutral',
+                "language": language
+            })
+        return voices
+
+
+def accent_for_language(language_code):
+    if language_code == "en-US":
+        return "American"
+    elif language_code == "en-GB":
+        return "British"
+    elif language_code == "en-AU":
+        return "Australian"
+    elif language_code == "en-IN":
+        return "Indian"
+    return language_code
+
+
+def create_tts_backend(name):
+    """Instantiate a backend by name, returning None if it cannot run here."""
+    try:
+        if name == 'google':
+            return GoogleTTSBackend() if client is not None else None
+        if name == 'synthetic':
+            return SyntheticTTSBackend()
+        if name == 'local':
+            return LocalTTSBackend()
+        logger.error(f"Unknown TTS backend: {name}")
+    except Exception as e:
+        logger.error(f"Failed to initialize {name} TTS backend: {str(e)}")
+    return None
+
+
+tts_backend = create_tts_backend(TTS_BACKEND)
+if tts_backend is None and TTS_FALLBACK_BACKEND not in ('', 'none', TTS_BACKEND):
+    logger.warning(f"TTS backend '{TTS_BACKEND}' unavailable, falling back to '{TTS_FALLBACK_BACKEND}'")
+    tts_backend = create_tts_backend(TTS_FALLBACK_BACKEND)
+if tts_backend is not None:
+    logger.info(f"Using '{tts_backend.name}' TTS backend")
+
+
+# --- Voice Catalog ---
+
+VOICE_CATALOG_TTL = int(os.environ.get("VOICE_CATALOG_TTL", 3600))  # Seconds a catalog counts as fresh
+VOICE_CATALOG_MAX_STALE = int(os.environ.get("VOICE_CATALOG_MAX_STALE", 86400))  # Serve stale this long while refreshing
+VOICE_CATALOG_SNAPSHOT = os.environ.get(
+    "VOICE_CATALOG_SNAPSHOT",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "voice_catalog.json")
+)
+
+
+class VoiceCatalog:
+    """In-memory voice list with TTL and stale-while-revalidate refresh.
+
+    The catalog is indexed by language, accent and gender when loaded, and the
+    unfiltered JSON body and its ETag are precomputed, so requests never wait on
+    the backend unless the catalog is missing or older than ttl + max_stale.
+
+    Every successful refresh is written to a snapshot file that new workers load
+    at start, so they can answer before (or without) reaching the backend.
+    """
+
+    FILTERS = ('language', 'accent', 'gender')
+
+    def __init__(self, loader, ttl, max_stale, snapshot_path=None, source=None):
+        self._loader = loader
+        self.ttl = ttl
+        self.max_stale = max_stale
+        self.snapshot_path = snapshot_path
+        self.source = source
+        self._lock = threading.Lock()
+        self._refreshing = False
+        self._state = None
+        self._stats = Counter()
+        self._load_snapshot()
+
+    def get(self):
+        """Return the current catalog state, loading or scheduling a refresh as needed"""
+        state = self._state
+        if state is None:
+            return self.refresh()
+        age = time.time() - state['loaded_at']
+        if age > self.ttl + self.max_stale:
+            try:
+                return self.refresh()
+            except Exception as e:
+                logger.warning(f"Voice catalog refresh failed, serving {age:.0f}s old data: {str(e)}")
+        elif age > self.ttl:
+            self._refresh_in_background()
+        self._stats['served'] += 1
+        return state
+
+    def refresh(self):
+        """Reload synchronously; raises if the loader fails"""
+        try:
+            voices = self._loader()
+        except Exception:
+            self._stats['failures'] += 1
+            raise
+        self._state = self._build(voices)
+        self._stats['refreshes'] += 1
+        logger.info(f"Voice catalog refreshed with {len(voices)} voices")
+        self._save_snapshot(self._state)
+        return self._state
+
+    def _load_snapshot(self):
+        if not self.snapshot_path:
+            return
+        try:
+            with open(self.snapshot_path, encoding='utf-8') as f:
+                snapshot = json.load(f)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as e:
+            logger.warning(f"Ignoring unreadable voice catalog snapshot {self.snapshot_path}: {str(e)}")
+            return
+        if snapshot.get('source') != self.source or not isinstance(snapshot.get('voices'), list):
+            logger.info("Voice catalog snapshot is for a different backend, ignoring it")
+            return
+        self._state = self._build(snapshot['voices'], loaded_at=snapshot.get('savedAt', 0))
+        logger.info(f"Voice catalog loaded {len(snapshot['voices'])} voices from snapshot")
+
+    def _save_snapshot(self, state):
+        if not self.snapshot_path:
+            return
+        tmp_path = f"{self.snapshot_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump({'source': self.source, 'savedAt': state['loaded_at'], 'voices': state['voices']}, f)
+            os.replace(tmp_path, self.snapshot_path)
+        except OSError as e:
+            logger.warning(f"Failed to write voice catalog snapshot: {str(e)}")
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+
+    def warm(self):
+        """Refresh in the background at startup unless a fresh snapshot was loaded"""
+        state = self._state
+        if state is None or time.time() - state['loaded_at'] > self.ttl:
+            self._refresh_in_background()
+
+    def _refresh_in_background(self):
+        with self._lock:
+            if self._refreshing:
+                return
+            self._refreshing = True
+
+        def run():
+            try:
+                self.refresh()
+            except Exception as e:
+                logger.warning(f"Background voice catalog refresh failed, serving stale data: {str(e)}")
+            finally:
+                with self._lock:
+                    self._refreshing = False
+
+        threading.Thread(target=run, name='voice-catalog-refresh', daemon=True).start()
+
+    def _build(self, voices, loaded_at=None):
+        index = {field: defaultdict(set) for field in self.FILTERS}
+        for position, voice in enumerate(voices):
+            for field in self.FILTERS:
+                index[field][str(voice.get(field, '')).lower()].add(position)
+        body = json.dumps(voices, separators=(',', ':'))
+        return {
+            'voices': voices,
+            'index': index,
+            'body': body,
+            'etag': hashlib.sha256(body.encode('utf-8')).hexdigest()[:32],
+            'loaded_at': time.time() if loaded_at is None else loaded_at,
+        }
+
+    def query(self, state, filters):
+        """Voices matching every given filter value (case-insensitive)"""
+        positions = None
+        for field, value in filters.items():
+            matches = state['index'][field].get(value.lower(), set())
+            positions = matches if positions is None else positions & matches
+        if positions is None:
+            return state['voices']
+        return [state['voices'][position] for position in sorted(positions)]
+
+    def stats(self):
+        state = self._state
+        return {
+            'voices': len(state['voices']) if state else 0,
+            'ageSeconds': round(time.time() - state['loaded_at'], 1) if state else None,
+            'served': self._stats['served'],
+            'refreshes': self._stats['refreshes'],
+            'failures': self._stats['failures'],
+        }
+
+
+voice_catalog = VoiceCatalog(
+    lambda: tts_backend.list_voices(),
+    VOICE_CATALOG_TTL,
+    VOICE_CATALOG_MAX_STALE,
+    snapshot_path=VOICE_CATALOG_SNAPSHOT,
+    source=tts_backend.name if tts_backend is not None else None
+)
+if tts_backend is not None:
+    voice_catalog.warm()
+
+
+# --- TTS Audio Cache ---
+
+TTS_CACHE_DIR = os.environ.get(
+    "TTS_CACHE_DIR",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "tts_cache")
+)
+TTS_CACHE_MEMORY_BYTES = int(float(os.environ.get("TTS_CACHE_MEMORY_MB", 64)) * 1024 * 1024)
+TTS_CACHE_DISK_BYTES = int(float(os.environ.get("TTS_CACHE_DISK_MB", 1024)) * 1024 * 1024)
+
+# Everything that changes the synthesized audio must be part of this tuple,
+# since the cache key is derived from it. word_marks requests SSML mark
+# timepoints between words, which are cached alongside the audio.
+TTSParams = namedtuple(
+    'TTSParams',
+    ['text', 'voice_id', 'language_code', 'speed', 'encoding', 'word_marks', 'sample_rate', 'backend'],
+    defaults=(False, None, 'google')
+)
+
+# Encodings we can serve, in order of preference when the client accepts several
+AUDIO_FORMATS = OrderedDict([
+    ('MP3', {'mimetype': 'audio/mpeg', 'extension': 'mp3'}),
+    ('OGG_OPUS', {'mimetype': 'audio/ogg', 'extension': 'ogg'}),
+    ('LINEAR16', {'mimetype': 'audio/wav', 'extension': 'wav'}),
+])
+ENCODING_ALIASES = {
+    'mp3': 'MP3',
+    'ogg_opus': 'OGG_OPUS',
+    'opus': 'OGG_OPUS',
+    'ogg': 'OGG_OPUS',
+    'linear16': 'LINEAR16',
+    'wav': 'LINEAR16',
+}
+
+
+def normalize_tts_text(text):
+    """Collapse whitespace so trivially different inputs share a cache entry"""
+    return ' '.join(text.split())
+
+
+def tts_cache_key(params):
+    """Content-addressed key for a synthesis request"""
+    payload = json.dumps(list(params), separators=(',', ':'), ensure_ascii=False)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+class AudioCache:
+    """Two-tier audio cache: an in-process LRU in front of an on-disk store.
+
+    Audio files are written atomically and tracked in a SQLite index, so a
+    crash can at worst leave an orphaned file that is removed on a later start.
+    Both tiers evict least-recently-used entries once their byte budget is exceeded;
+    the disk budget is measured from the shared index, so it holds across processes.
+    """
+
+    # Unindexed files younger than this may still be in flight in another process
+    STALE_FILE_AGE = 60 * 60  # Seconds
+
+    def __init__(self, cache_dir, memory_limit, disk_limit):
+        self.cache_dir = cache_dir
+        self.memory_limit = memory_limit
+        self.disk_limit = disk_limit
+        self._memory = OrderedDict()
+        self._memory_bytes = 0
+        self._lock = threading.Lock()
+        self._stats = Counter()
+        self._db = None
+
+        if disk_limit > 0:
+            try:
+                os.makedirs(cache_dir, exist_ok=True)
+                self._db = sqlite3.connect(
+                    os.path.join(cache_dir, 'index.sqlite3'),
+                    check_same_thread=False,
+                    isolation_level=None  # autocommit; each statement is its own transaction
+                )
+                self._db.execute('PRAGMA journal_mode=WAL')
+                self._db.execute(
+                    'CREATE TABLE IF NOT EXISTS entries ('
+                    'key TEXT PRIMARY KEY, size INTEGER NOT NULL, last_access REAL NOT NULL, meta TEXT)'
+                )
+                columns = [row[1] for row in self._db.execute('PRAGMA table_info(entries)')]
+                if 'meta' not in columns:
+                    self._db.execute('ALTER TABLE entries ADD COLUMN meta TEXT')
+                self._recover()
+            except (OSError, sqlite3.Error) as e:
+                logger.error(f"Disk audio cache unavailable, using memory only: {str(e)}")
+                self._db = None
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, f"{key}.audio")
+
+    def _recover(self):
+        """Reconcile the index with the files actually on disk"""
+        indexed = {}
+        for key, size in self._db.execute('SELECT key, size FROM entries'):
+            path = self._path(key)
+            if os.path.exists(path) and os.path.getsize(path) == size:
+                indexed[key] = size
+            else:
+                self._db.execute('DELETE FROM entries WHERE key = ?', (key,))
+
+        stale_before = time.time() - self.STALE_FILE_AGE
+        for name in os.listdir(self.cache_dir):
+            if name.endswith('.tmp') or (name.endswith('.audio') and name[:-len('.audio')] not in indexed):
+                path = os.path.join(self.cache_dir, name)
+                try:
+                    if os.path.getmtime(path) < stale_before:
+                        os.remove(path)
+                except OSError:
+                    pass
+
+        logger.info(f"Audio cache loaded {len(indexed)} entries ({sum(indexed.values())} bytes) from {self.cache_dir}")
+        self._evict_disk()
+
+    def get(self, key):
+        entry = self.get_entry(key)
+        return entry[0] if entry is not None else None
+
+    def get_entry(self, key):
+        """Return (audio, meta) for key, or None on a miss"""
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None:
+                self._memory.move_to_end(key)
+                self._stats['memory_hits'] += 1
+                return entry
+
+        entry = self._read_disk(key)
+        with self._lock:
+            if entry is None:
+                self._stats['misses'] += 1
+                return None
+            self._stats['disk_hits'] += 1
+            self._remember(key, entry)
+            return entry
+
+    def contains(self, key):
+        """Check for key in either tier without touching the LRU order or counters"""
+        with self._lock:
+            if key in self._memory:
+                return True
+            if self._db is None:
+                return False
+            try:
+                return self._db.execute('SELECT 1 FROM entries WHERE key = ?', (key,)).fetchone() is not None
+            except sqlite3.Error:
+                return False
+
+    def put(self, key, audio, meta=None):
+        if not audio:
+            return
+        entry = (audio, meta or {})
+        with self._lock:
+            self._remember(key, entry)
+            self._stats['stores'] += 1
+        self._write_disk(key, entry)
+
+    def _remember(self, key, entry):
+        """Insert into the memory tier; caller must hold the lock"""
+        if len(entry[0]) > self.memory_limit:
+            return
+        previous = self._memory.pop(key, None)
+        if previous is not None:
+            self._memory_bytes -= len(previous[0])
+        self._memory[key] = entry
+        self._memory_bytes += len(entry[0])
+        while self._memory_bytes > self.memory_limit:
+            _, evicted = self._memory.popitem(last=False)
+            self._memory_bytes -= len(evicted[0])
+            self._stats['memory_evictions'] += 1
+
+    def _read_disk(self, key):
+        if self._db is None:
+            return None
+        try:
+            with open(self._path(key), 'rb') as f:
+                audio = f.read()
+        except OSError:
+            return None
+        with self._lock:
+            try:
+                self._db.execute('UPDATE entries SET last_access = ? WHERE key = ?', (time.time(), key))
+                row = self._db.execute('SELECT meta, size FROM entries WHERE key = ?', (key,)).fetchone()
+            except sqlite3.Error as e:
+                logger.warning(f"Failed to read audio cache index: {str(e)}")
+                row = None
+        if row is None:
+            return None
+        if len(audio) != row[1]:
+            # Never serve (or pin in memory) a file that is shorter or longer than indexed
+            logger.warning(f"Audio cache entry {key} has {len(audio)} bytes, index says {row[1]}; ignoring it")
+            return None
+        return audio, json.loads(row[0] or '{}')
+
+    def _write_disk(self, key, entry):
+        audio, meta = entry
+        if self._db is None or len(audio) > self.disk_limit:
+            return
+        path = self._path(key)
+        # Forked workers share the main thread's ident, so the pid is needed too
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            with open(tmp_path, 'wb') as f:
+                f.write(audio)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, path)
+            with self._lock:
+                self._db.execute(
+                    'INSERT OR REPLACE INTO entries (key, size, last_access, meta) VALUES (?, ?, ?, ?)',
+                    (key, len(audio), time.time(), json.dumps(meta))
+                )
+                self._evict_disk()
+        except (OSError, sqlite3.Error) as e:
+            logger.warning(f"Failed to write audio cache entry {key}: {str(e)}")
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+
+    def _disk_bytes(self):
+        """Total size of indexed entries across all processes; caller must hold the lock"""
+        if self._db is None:
+            return 0
+        return self._db.execute('SELECT COALESCE(SUM(size), 0) FROM entries').fetchone()[0]
+
+    def _evict_disk(self):
+        """Drop least-recently-used disk entries; caller must hold the lock"""
+        disk_bytes = self._disk_bytes()
+        if disk_bytes <= self.disk_limit:
+            return
+        rows = self._db.execute('SELECT key, size FROM entries ORDER BY last_access ASC').fetchall()
+        for key, size in rows:
+            if disk_bytes <= self.disk_limit:
+                break
+            self._db.execute('DELETE FROM entries WHERE key = ?', (key,))
+            try:
+                os.remove(self._path(key))
+            except OSError:
+                pass
+            disk_bytes -= size
+            self._stats['disk_evictions'] += 1
+
+    def stats(self):
+        with self._lock:
+            hits = self._stats['memory_hits'] + self._stats['disk_hits']
+            lookups = hits + self._stats['misses']
+            return {
+                'memoryHits': self._stats['memory_hits'],
+                'diskHits': self._stats['disk_hits'],
+                'misses': self._stats['misses'],
+                'hitRate': round(hits / lookups, 4) if lookups else None,
+                'memoryEntries': len(self._memory),
+                'memoryBytes': self._memory_bytes,
+                'diskBytes': self._disk_bytes(),
+                'evictions': self._stats['memory_evictions'] + self._stats['disk_evictions'],
+            }
+
+
+tts_cache = AudioCache(TTS_CACHE_DIR, TTS_CACHE_MEMORY_BYTES, TTS_CACHE_DISK_BYTES)
+
+
+class SingleFlight:
+    """Coalesce concurrent calls that share a key into one execution.
+
+    The first caller for a key runs the work; anyone arriving while it is in
+    flight waits on the same Future and receives the same result or exception.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+        self._stats = Counter()
+
+    def submit(self, key, start):
+        """Return (future, shared): the in-flight Future for key, or the one start() creates"""
+        with self._lock:
+            future = self._calls.get(key)
+            if future is not None:
+                self._stats['coalesced'] += 1
+                return future, True
+            future = start()
+            self._calls[key] = future
+            self._stats['executed'] += 1
+        future.add_done_callback(lambda done: self._forget(key, done))
+        return future, False
+
+    def do(self, key, fn):
+        """Run fn() unless an identical call is already in flight; returns (result, shared)"""
+        own = Future()
+        future, shared = self.submit(key, lambda: own)
+        if shared:
+            return future.result(), True
+        try:
+            result = fn()
+        except BaseException as e:
+            own.set_exception(e)
+            raise
+        own.set_result(result)
+        return result, False
+
+    def _forget(self, key, future):
+        with self._lock:
+            if self._calls.get(key) is future:
+                del self._calls[key]
+
+    def stats(self):
+        with self._lock:
+            return {
+                'executed': self._stats['executed'],
+                'coalesced': self._stats['coalesced'],
+                'inFlight': len(self._calls),
+            }
+
+
+tts_singleflight = SingleFlight()
+
+
+# --- Long-text Synthesis ---
+
+GOOGLE_TTS_MAX_INPUT_BYTES = 5000  # Per-request limit enforced by Google
+TTS_CHUNK_BYTES = min(int(os.environ.get("TTS_CHUNK_BYTES", 1000)), GOOGLE_TTS_MAX_INPUT_BYTES)
+TTS_MAX_WORKERS = int(os.environ.get("TTS_MAX_WORKERS", 8))
+
+# Bounded pool for synthesizing the chunks of a single long request
+tts_chunk_executor = ThreadPoolExecutor(max_workers=TTS_MAX_WORKERS, thread_name_prefix='tts-chunk')
+
+# Batch items get their own pool: a long item fans out into the chunk pool,
+# and sharing one pool between the two levels could deadlock.
+TTS_BATCH_MAX_ITEMS = int(os.environ.get("TTS_BATCH_MAX_ITEMS", 50))
+TTS_BATCH_PARALLELISM = int(os.environ.get("TTS_BATCH_PARALLELISM", 4))
+tts_batch_executor = ThreadPoolExecutor(max_workers=TTS_BATCH_PARALLELISM, thread_name_prefix='tts-batch')
+
+
+# Cache TTS text sentence by sentence so edits only re-synthesize what changed
+TTS_SENTENCE_UNITS = os.environ.get("TTS_SENTENCE_UNITS", "False").lower() in ('true', '1', 't')
+
+# Serve non-1.0x speeds by time-stretching a cached 1.0x LINEAR16 synthesis locally
+TTS_DERIVE_SPEEDS = os.environ.get("TTS_DERIVE_SPEEDS", "False").lower() in ('true', '1', 't')
+# Longer clips (and longText / incremental requests) are synthesized at the requested
+# speed upstream instead; the phase vocoder's time and memory grow with the clip
+TTS_DERIVE_MAX_SECONDS = float(os.environ.get("TTS_DERIVE_MAX_SECONDS", 60))
+
+
+# --- TTS Cache Warm-up ---
+
+TTS_WARMUP_MANIFEST = os.environ.get(
+    "TTS_WARMUP_MANIFEST",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "tts_warmup.json")
+)
+TTS_WARMUP_ON_START = os.environ.get("TTS_WARMUP_ON_START", "False").lower() in ('true', '1', 't')
+# Only the first serving process to create this file warms the cache; a file older
+# than TTS_WARMUP_LOCK_AGE is assumed to belong to a process that died mid-warm-up
+TTS_WARMUP_LOCK_PATH = os.path.join(TTS_CACHE_DIR, 'warmup.lock')
+TTS_WARMUP_LOCK_AGE = 60 * 60  # Seconds
+tts_warmup_lock = threading.Lock()
+tts_warmup_started = False
+TTS_STATIC_MAX_AGE = 365 * 24 * 60 * 60  # Audio URLs are content-addressed, so they never change
+
+
+# --- Summary Cache ---
+
+SUMMARY_CACHE_PATH = os.environ.get(
+    "SUMMARY_CACHE_PATH",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "summary_cache.sqlite3")
+)
+SUMMARY_CACHE_TTL = int(os.environ.get("SUMMARY_CACHE_TTL", 7 * 24 * 60 * 60))  # Seconds
+SUMMARY_CACHE_MAX_ENTRIES = int(os.environ.get("SUMMARY_CACHE_MAX_ENTRIES", 10000))
+# Bump whenever the Gemini prompt, its output contract or the NLTK pipeline changes
+# what a summary looks like; Gemini entries are also keyed by GEMINI_MODEL
+SUMMARY_PROMPT_VERSION = "4"
+SUMMARY_LEVELS = ('high', 'medium', 'low')
+# Fields sent as SSE events by /api/summarize/stream, with their list limits
+STREAMED_SUMMARY_FIELDS = {'summary': None, 'keyConcepts': 6, 'focusPoints': 3, 'relatedTopics': 4}
+
+
+class SummaryCache:
+    """Persistent summary results in SQLite (WAL mode, shared by all workers).
+
+    Entries are keyed by a hash of the normalized text, compression level,
+    engine (with the model, for Gemini) and prompt version; they expire after ttl seconds and the least
+    recently used ones are dropped beyond max_entries.
+    """
+
+    def __init__(self, path, ttl, max_entries):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._stats = Counter()
+        self._db = None
+        try:
+            self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=5)
+            self._db.execute('PRAGMA journal_mode=WAL')
+            self._db.execute(
+                'CREATE TABLE IF NOT EXISTS summaries ('
+                'key TEXT PRIMARY KEY, result TEXT NOT NULL, '
+                'created_at REAL NOT NULL, last_access REAL NOT NULL)'
+            )
+            self._db.execute('CREATE INDEX IF NOT EXISTS summaries_last_access ON summaries (last_access)')
+        except sqlite3.Error as e:
+            logger.error(f"Summary cache unavailable: {str(e)}")
+            self._db = None
+
+    @staticmethod
+    def key(text, level, engine):
+        text_hash = hashlib.sha256(' '.join(text.split()).encode('utf-8')).hexdigest()
+        if engine == 'gemini':
+            engine = f"gemini/{GEMINI_MODEL}"
+        return f"{text_hash}:{level}:{engine}:{SUMMARY_PROMPT_VERSION}"
+
+    def get(self, text, level, engine):
+        if self._db is None:
+            return None
+        key = self.key(text, level, engine)
+        now = time.time()
+        with self._lock:
+            try:
+                row = self._db.execute(
+                    'SELECT result, created_at FROM summaries WHERE key = ?', (key,)
+                ).fetchone()
+                if row is None or now - row[1] > self.ttl:
+                    self._stats['misses'] += 1
+                    return None
+                self._db.execute('UPDATE summaries SET last_access = ? WHERE key = ?', (now, key))
+            except sqlite3.Error as e:
+                logger.warning(f"Summary cache read failed: {str(e)}")
+                return None
+            self._stats['hits'] += 1
+        return json.loads(row[0])
+
+    def contains(self, text, level, engine):
+        """Check for a fresh entry without touching hit/miss stats"""
+        if self._db is None:
+            return False
+        with self._lock:
+            try:
+                row = self._db.execute(
+                    'SELECT created_at FROM summaries WHERE key = ?', (self.key(text, level, engine),)
+                ).fetchone()
+            except sqlite3.Error:
+                return False
+        return row is not None and time.time() - row[0] <= self.ttl
+
+    def put(self, text, level, engine, result):
+        if self._db is None:
+            return
+        key = self.key(text, level, engine)
+        now = time.time()
+        with self._lock:
+            try:
+                self._db.execute(
+                    'INSERT OR REPLACE INTO summaries (key, result, created_at, last_access) VALUES (?, ?, ?, ?)',
+                    (key, json.dumps(result), now, now)
+                )
+                self._stats['stores'] += 1
+                if self._stats['stores'] % 100 == 0:
+                    self._evict(now)
+            except sqlite3.Error as e:
+                logger.warning(f"Summary cache write failed: {str(e)}")
+
+    def _evict(self, now):
+        """Drop expired rows and trim to max_entries; caller must hold the lock"""
+        expired = self._db.execute('DELETE FROM summaries WHERE created_at < ?', (now - self.ttl,)).rowcount
+        excess = self._db.execute(
+            'DELETE FROM summaries WHERE key IN ('
+            'SELECT key FROM summaries ORDER BY last_access DESC LIMIT -1 OFFSET ?)',
+            (self.max_entries,)
+        ).rowcount
+        self._stats['evictions'] += expired + excess
+
+    def stats(self):
+        with self._lock:
+            lookups = self._stats['hits'] + self._stats['misses']
+            return {
+                'hits': self._stats['hits'],
+                'misses': self._stats['misses'],
+                'hitRate': round(self._stats['hits'] / lookups, 4) if lookups else None,
+                'stores': self._stats['stores'],
+                'evictions': self._stats['evictions'],
+            }
+
+
+summary_cache = SummaryCache(SUMMARY_CACHE_PATH, SUMMARY_CACHE_TTL, SUMMARY_CACHE_MAX_ENTRIES)
+
+
+# --- Long-document Summarization ---
+
+# Token counts are estimated from UTF-8 size; close enough for budgeting prompts
+SUMMARY_BYTES_PER_TOKEN = 4
+SUMMARY_SECTION_TOKENS = int(os.environ.get("SUMMARY_SECTION_TOKENS", 2000))
+# Texts over this many tokens (or over SUMMARY_PROMPT_TOKENS, see SUMMARY_MAP_REDUCE_TOKENS)
+# are summarized map-reduce style even without longText
+SUMMARY_LONG_TEXT_TOKENS = int(os.environ.get("SUMMARY_LONG_TEXT_TOKENS", 8000))
+SUMMARY_MAX_WORKERS = int(os.environ.get("SUMMARY_MAX_WORKERS", 4))
+
+# Bounded pool for summarizing the sections of a single long document
+summary_section_executor = ThreadPoolExecutor(max_workers=SUMMARY_MAX_WORKERS, thread_name_prefix='summary-section')
+
+# Extractive pre-compression: text over SUMMARY_PROMPT_TOKENS keeps only its
+# highest-scoring sentences before it goes into a Gemini prompt. Shorter text
+# bypasses scoring and only has its whitespace tidied.
+SUMMARY_PRECOMPRESS = os.environ.get("SUMMARY_PRECOMPRESS", "True").lower() in ('true', '1', 't')
+SUMMARY_PROMPT_TOKENS = int(os.environ.get("SUMMARY_PROMPT_TOKENS", 3000))
+# A whole document over the prompt budget goes map-reduce rather than losing most
+# of its sentences, so with pre-compression on the effective long-text threshold
+# is the smaller of the two settings. Only the reduce step is ever pre-compressed,
+# as long as SUMMARY_SECTION_TOKENS stays within SUMMARY_PROMPT_TOKENS.
+SUMMARY_MAP_REDUCE_TOKENS = (
+    min(SUMMARY_LONG_TEXT_TOKENS, SUMMARY_PROMPT_TOKENS) if SUMMARY_PRECOMPRESS else SUMMARY_LONG_TEXT_TOKENS
+)
+prompt_compression_stats = Counter()
+
+# Batch documents get their own pool, since a long document fans out into the section pool
+SUMMARY_BATCH_MAX_ITEMS = int(os.environ.get("SUMMARY_BATCH_MAX_ITEMS", 20))
+SUMMARY_BATCH_PARALLELISM = int(os.environ.get("SUMMARY_BATCH_PARALLELISM", 4))
+summary_batch_executor = ThreadPoolExecutor(max_workers=SUMMARY_BATCH_PARALLELISM, thread_name_prefix='summary-batch')
+
+# Latency budget for /api/summarize: Gemini races the NLTK pipeline and, if it
+# misses the deadline, the NLTK result is returned while Gemini finishes in the
+# background and fills the cache. 0 disables the race.
+SUMMARY_DEADLINE = float(os.environ.get("SUMMARY_DEADLINE", 0))  # Seconds
+SUMMARY_RACE_WORKERS = int(os.environ.get("SUMMARY_RACE_WORKERS", 4))
+summary_race_executor = ThreadPoolExecutor(max_workers=SUMMARY_RACE_WORKERS, thread_name_prefix='summary-race')
+# One slot per race worker: a race only starts when Gemini can begin at once, so
+# requests never queue behind late calls that already missed their deadline
+summary_race_slots = threading.BoundedSemaphore(SUMMARY_RACE_WORKERS)
+summary_deadline_stats = Counter()
+
+
+# --- Summary Jobs ---
+
+SUMMARY_JOBS_PATH = os.environ.get(
+    "SUMMARY_JOBS_PATH",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "summary_jobs.sqlite3")
+)
+SUMMARY_JOB_WORKERS = int(os.environ.get("SUMMARY_JOB_WORKERS", 2))  # Per process; 0 disables job processing
+# A running job whose lease expires (its worker died) is handed to another worker
+SUMMARY_JOB_LEASE = int(os.environ.get("SUMMARY_JOB_LEASE", 15 * 60))  # Seconds
+SUMMARY_JOB_MAX_ATTEMPTS = int(os.environ.get("SUMMARY_JOB_MAX_ATTEMPTS", 3))
+SUMMARY_JOB_RETENTION = int(os.environ.get("SUMMARY_JOB_RETENTION", 24 * 60 * 60))  # Seconds
+SUMMARY_JOB_MAX_WAIT = 30  # Longest long-poll, in seconds
+
+
+class SummaryJobQueue:
+    """Durable summarization jobs in SQLite (WAL mode, shared by all workers).
+
+    Jobs move queued -> running -> done/failed. Claiming is a single
+    transaction, so several processes can pull from the same file; a job left
+    running past its lease is re-queued until max_attempts is reached.
+    """
+
+    def __init__(self, path, lease, max_attempts, retention):
+        self.lease = lease
+        self.max_attempts = max_attempts
+        self.retention = retention
+        self._lock = threading.Lock()
+        self._changed = threading.Condition(self._lock)
+        self._db = None
+        try:
+            self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=5)
+            self._db.execute('PRAGMA journal_mode=WAL')
+            self._db.execute(
+                'CREATE TABLE IF NOT EXISTS jobs ('
+                'id TEXT PRIMARY KEY, status TEXT NOT NULL, request TEXT NOT NULL, '
+                'result TEXT, error TEXT, attempts INTEGER NOT NULL DEFAULT 0, '
+                'created_at REAL NOT NULL, updated_at REAL NOT NULL, lease_until REAL)'
+            )
+            self._db.execute('CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, created_at)')
+        except sqlite3.Error as e:
+            logger.error(f"Summary job queue unavailable: {str(e)}")
+            self._db = None
+
+    @property
+    def available(self):
+        return self._db is not None
+
+    def submit(self, job_request):
+        job_id = uuid.uuid4().hex
+        now = time.time()
+        with self._lock:
+            self._db.execute(
+                'INSERT INTO jobs (id, status, request, created_at, updated_at) VALUES (?, ?, ?, ?, ?)',
+                (job_id, 'queued', json.dumps(job_request), now, now)
+            )
+            self._changed.notify_all()
+        return job_id
+
+    def claim(self):
+        """Lease the oldest runnable job; returns (job_id, request) or None."""
+        now = time.time()
+        with self._lock:
+            try:
+                self._db.execute('BEGIN IMMEDIATE')
+                try:
+                    self._db.execute(
+                        "UPDATE jobs SET status = 'failed', error = ?, updated_at = ? "
+                        "WHERE status = 'running' AND lease_until < ? AND attempts >= ?",
+                        ('Job did not finish after repeated attempts', now, now, self.max_attempts)
+                    )
+                    row = self._db.execute(
+                        "SELECT id, request FROM jobs WHERE status = 'queued' "
+                        "OR (status = 'running' AND lease_until < ?) ORDER BY created_at LIMIT 1",
+                        (now,)
+                    ).fetchone()
+                    if row is not None:
+                        self._db.execute(
+                            "UPDATE jobs SET status = 'running', attempts = attempts + 1, "
+                            "lease_until = ?, updated_at = ? WHERE id = ?",
+                            (now + self.lease, now, row[0])
+                        )
+                    self._db.execute('COMMIT')
+                except Exception:
+                    self._db.execute('ROLLBACK')
+                    raise
+            except sqlite3.Error as e:
+                logger.warning(f"Summary job claim failed: {str(e)}")
+                return None
+        if row is None:
+            return None
+        return row[0], json.loads(row[1])
+
+    def renew(self, job_id):
+        """Extend the lease of a job that is still running"""
+        with self._lock:
+            self._db.execute(
+                "UPDATE jobs SET lease_until = ? WHERE id = ? AND status = 'running'",
+                (time.time() + self.lease, job_id)
+            )
+
+    def complete(self, job_id, result):
+        self._finish(job_id, 'done', result=json.dumps(result))
+
+    def fail(self, job_id, error):
+        self._finish(job_id, 'failed', error=error)
+
+    def _finish(self, job_id, status, result=None, error=None):
+        now = time.time()
+        with self._lock:
+            self._db.execute(
+                'UPDATE jobs SET status = ?, result = ?, error = ?, lease_until = NULL, updated_at = ? WHERE id = ?',
+                (status, result, error, now, job_id)
+            )
+            self._db.execute(
+                "DELETE FROM jobs WHERE status IN ('done', 'failed') AND updated_at < ?",
+                (now - self.retention,)
+            )
+            self._changed.notify_all()
+
+    def get(self, job_id):
+        with self._lock:
+            return self._get(job_id)
+
+    def _get(self, job_id):
+        row = self._db.execute(
+            'SELECT status, result, error, attempts, created_at, updated_at FROM jobs WHERE id = ?', (job_id,)
+        ).fetchone()
+        if row is None:
+            return None
+        status, result, error, attempts, created_at, updated_at = row
+        job = {'jobId': job_id, 'status': status, 'attempts': attempts,
+               'createdAt': created_at, 'updatedAt': updated_at}
+        if result is not None:
+            job.update(json.loads(result))
+        if error is not None:
+            job['error'] = error
+        return job
+
+    def wait(self, job_id, timeout):
+        """Long-poll: return the job once it is done or failed, or after timeout seconds."""
+        deadline = time.time() + timeout
+        with self._lock:
+            while True:
+                job = self._get(job_id)
+                remaining = deadline - time.time()
+                if job is None or job['status'] in ('done', 'failed') or remaining <= 0:
+                    return job
+                # Re-check at least every second; another process may finish the job
+                self._changed.wait(min(remaining, 1.0))
+
+    def wait_for_work(self, timeout):
+        with self._lock:
+            self._changed.wait(timeout)
+
+    def stats(self):
+        if self._db is None:
+            return {'available': False}
+        with self._lock:
+            rows = self._db.execute('SELECT status, COUNT(*) FROM jobs GROUP BY status').fetchall()
+        return dict(rows, available=True)
+
+
+summary_jobs = SummaryJobQueue(SUMMARY_JOBS_PATH, SUMMARY_JOB_LEASE, SUMMARY_JOB_MAX_ATTEMPTS, SUMMARY_JOB_RETENTION)
+# Workers start only in processes that serve requests (see start_summary_job_workers),
+# never in CLI commands or the debug reloader's parent
+summary_job_workers_lock = threading.Lock()
+summary_job_workers_started = False
+
 
 def download_nltk_resources():
     try:
@@ -109,11 +1289,16 @@ def handle_exception(e):
 
 # --- API Endpoints ---
 
+def used_upstream(response):
+    """Rate-limit deduction hook: cache hits and coalesced requests cost nothing."""
+    return response.headers.get('X-Cache') != 'HIT'
+
+
 @app.route('/api/tts', methods=['POST'])
-@limiter.limit("10 per minute")  # Apply rate limiting
+@limiter.limit("10 per minute", deduct_when=used_upstream)  # Apply rate limiting
 def text_to_speech():
-     if client is None:
-        logger.error("Google Cloud TTS client not initialized")
+     if tts_backend is None:
+        logger.error("No TTS backend available")
         return jsonify({'error': 'Text-to-speech service unavailable'}), 503
 
      try:
@@ -123,65 +1308,59 @@ def text_to_speech():
             logger.warning("No JSON data received in request")
             return jsonify({'error': 'Invalid request: No JSON data'}), 400
 
-        if 'text' not in data or not data['text'].strip():
-            logger.warning("Missing or empty 'text' field in request")
-            return jsonify({'error': 'Text is required'}), 400
-
-        text = data.get('text', '').strip()
-        voice_id = data.get('voiceId', 'en-US-Standard-D')  # Default
-
-        try:
-            speed = float(data.get('speed', 1.0))
-            if speed < 0.25 or speed > 4.0:
-                logger.warning(f"Speed value out of range: {speed}")
-                return jsonify({'error': 'Speed must be between 0.25 and 4.0'}), 400
-        except (TypeError, ValueError) as e:
-            logger.warning(f"Invalid speed value: {data.get('speed')}")
-            return jsonify({'error': 'Speed must be a valid number'}), 400
-
-        try:
-            language_code = '-'.join(voice_id.split('-')[:2])
-            if not language_code or len(language_code.split('-')) != 2:
-                raise ValueError("Invalid voice ID format")
-        except Exception:
-            logger.warning(f"Invalid voice ID format: {voice_id}")
-            return jsonify({'error': 'Invalid voice ID format'}), 400
-        logger.info(f"Processing TTS request: language={language_code}, voice={voice_id}, speed={speed}")
-        synthesis_input = texttospeech.SynthesisInput(text=text)
-
-        voice = texttospeech.VoiceSelectionParams(
-            language_code=language_code,
-            name=voice_id
-        )
-
-        audio_config = texttospeech.AudioConfig(
-            audio_encoding=texttospeech.AudioEncoding.MP3,
-            speaking_rate=speed
-        )
+        params, error = parse_tts_request(data, request.accept_mimetypes)
+        if error:
+            return jsonify({'error': error}), 400
+
+        if data.get('timepoints'):
+            return timed_audio_response(params)
+
+        long_text = bool(data.get('longText', False))
+        incremental = bool(data.get('incremental', TTS_SENTENCE_UNITS))
+        # Derived speeds are always LINEAR16 (WAV), 1.0x included, so a speed slider
+        # gets one format at every step. An explicit compressed encoding opts out of
+        # the server default and conflicts with an explicit deriveSpeed.
+        derive_speed = bool(data.get('deriveSpeed', TTS_DERIVE_SPEEDS))
+        if derive_speed and 'encoding' in data and params.encoding != 'LINEAR16':
+            if 'deriveSpeed' in data:
+                return jsonify({'error': 'deriveSpeed returns linear16 audio; omit encoding or request linear16'}), 400
+            derive_speed = False
+        if derive_speed and np is None:
+            logger.warning("numpy not installed; synthesizing the requested speed upstream")
+            derive_speed = False
 
         try:
-            logger.info("Calling Google TTS API")
-            response = client.synthesize_speech(
-                input=synthesis_input,
-                voice=voice,
-                audio_config=audio_config
-            )
-            logger.info("Successfully received TTS response")
-
-            if not response.audio_content:
+            if derive_speed and params.speed == 1.0:
+                params = params._replace(encoding='LINEAR16')
+                audio_content, cached = get_tts_audio(params, long_text, incremental)
+            elif derive_speed:
+                params = params._replace(encoding='LINEAR16')
+                audio_content, cached = get_derived_speed_audio(params, long_text, incremental)
+            else:
+                audio_content, cached = get_tts_audio(params, long_text, incremental)
+
+            if not audio_content:
                 logger.error("No audio content in Google TTS response")
                 return jsonify({'error': 'No audio generated'}), 500
 
-            audio_buffer = io.BytesIO(response.audio_content)
+            audio_buffer = io.BytesIO(audio_content)
             audio_buffer.seek(0)
 
             logger.info("Sending audio file response")
-            return send_file(
+            audio_format = AUDIO_FORMATS[params.encoding]
+            response = send_file(
                 audio_buffer,
-                mimetype="audio/mpeg",
+                mimetype=audio_format['mimetype'],
                 as_attachment=True,
-                download_name="speech.mp3"
+                download_name=f"speech.{audio_format['extension']}"
             )
+            response.headers['X-Cache'] = 'HIT' if cached else 'MISS'
+            response.vary.add('Accept')
+            key = tts_cache_key(params)
+            if tts_cache.contains(key):
+                # Point clients at the cacheable GET route for replays and seeking
+                response.headers['Content-Location'] = f"/api/tts/audio/{key}"
+            return response
 
         except exceptions.GoogleAPICallError as e:
             logger.error(f"Google API call error: {str(e)}")
@@ -192,56 +1371,216 @@ def text_to_speech():
         logger.error(traceback.format_exc())
         return jsonify({'error': f'Server error: {str(e)}'}), 500
 
+
+@app.route('/api/tts/stream', methods=['POST'])
+@limiter.limit("10 per minute")  # Apply rate limiting
+def text_to_speech_stream():
+    """Stream synthesized audio sentence by sentence as a chunked response."""
+    if tts_backend is None:
+        logger.error("No TTS backend available")
+        return jsonify({'error': 'Text-to-speech service unavailable'}), 503
+
+    try:
+        data = request.get_json()
+        if not data:
+            logger.warning("No JSON data received in request")
+            return jsonify({'error': 'Invalid request: No JSON data'}), 400
+
+        params, error = parse_tts_request(data, request.accept_mimetypes)
+        if error:
+            return jsonify({'error': error}), 400
+
+        units = split_tts_units(params.text)
+        if params.encoding == 'OGG_OPUS':
+            units = [params.text]  # Fits one request; Ogg segments would form a chained stream
+        segments = iter_tts_segments(params, units)
+
+        # Wait for the first sentence before committing to a 200, so upstream
+        # failures still surface as a proper error response.
+        try:
+            first_segment = next(segments)
+        except exceptions.GoogleAPICallError as e:
+            segments.close()
+            logger.error(f"Google API call error: {str(e)}")
+            return jsonify({'error': f'Text-to-speech API error: {str(e)}'}), 500
+
+        def generate():
+            yield stream_chunk(first_segment, params.encoding, first=True)
+            try:
+                for segment in segments:
+                    yield stream_chunk(segment, params.encoding, first=False)
+            except exceptions.GoogleAPICallError as e:
+                logger.error(f"Google API call error mid-stream: {str(e)}")
+            finally:
+                segments.close()
+
+        logger.info(f"Streaming TTS audio in {len(units)} segments")
+        response = Response(stream_with_context(generate()), mimetype=AUDIO_FORMATS[params.encoding]['mimetype'])
+        response.headers['Cache-Control'] = 'no-cache'
+        response.headers['X-Accel-Buffering'] = 'no'  # Keep reverse proxies from buffering the stream
+        return response
+
+    except Exception as e:
+        logger.error(f"Error in text_to_speech_stream: {str(e)}")
+        logger.error(traceback.format_exc())
+        return jsonify({'error': f'Server error: {str(e)}'}), 500
+
+@app.route('/api/tts/batch', methods=['POST'])
+@limiter.limit("10 per minute")  # Apply rate limiting
+def text_to_speech_batch():
+    """Synthesize many clips in one request, reporting success or failure per item."""
+    if tts_backend is None:
+        logger.error("No TTS backend available")
+        return jsonify({'error': 'Text-to-speech service unavailable'}), 503
+
+    try:
+        data = request.get_json()
+        if not data:
+            logger.warning("No JSON data received in request")
+            return jsonify({'error': 'Invalid request: No JSON data'}), 400
+
+        items = data.get('items')
+        if not isinstance(items, list) or not items:
+            return jsonify({'error': 'items must be a non-empty list'}), 400
+        if len(items) > TTS_BATCH_MAX_ITEMS:
+            return jsonify({'error': f'A batch may contain at most {TTS_BATCH_MAX_ITEMS} items'}), 400
+
+        try:
+            parallelism = int(data.get('parallelism', TTS_BATCH_PARALLELISM))
+        except (TypeError, ValueError):
+            return jsonify({'error': 'parallelism must be an integer'}), 400
+        parallelism = max(1, min(parallelism, TTS_BATCH_PARALLELISM))
+
+        logger.info(f"Processing TTS batch: {len(items)} items, parallelism={parallelism}")
+        results = map_bounded(tts_batch_executor, synthesize_batch_item, items, parallelism)
+        for index, result in enumerate(results):
+            result['index'] = index
+
+        failed = sum(1 for result in results if result['status'] == 'error')
+        logger.info(f"TTS batch finished: {len(results) - failed} succeeded, {failed} failed")
+        return jsonify({
+            'results': results,
+            'succeeded': len(results) - failed,
+            'failed': failed
+        })
+
+    except Exception as e:
+        logger.error(f"Error in text_to_speech_batch: {str(e)}")
+        logger.error(traceback.format_exc())
+        return jsonify({'error': f'Server error: {str(e)}'}), 500
+
+@app.route('/api/tts/sprites', methods=['POST'])
+@limiter.limit("10 per minute", deduct_when=used_upstream)  # Apply rate limiting
+def text_to_speech_sprites():
+    """Synthesize a sentence once and return it with per-word start/end offsets."""
+    if tts_backend is None:
+        logger.error("No TTS backend available")
+        return jsonify({'error': 'Text-to-speech service unavailable'}), 503
+
+    try:
+        data = request.get_json()
+        if not data:
+            logger.warning("No JSON data received in request")
+            return jsonify({'error': 'Invalid request: No JSON data'}), 400
+
+        params, error = parse_tts_request(data, request.accept_mimetypes)
+        if error:
+            return jsonify({'error': error}), 400
+        return timed_audio_response(params)
+
+    except Exception as e:
+        logger.error(f"Error in text_to_speech_sprites: {str(e)}")
+        logger.error(traceback.format_exc())
+        return jsonify({'error': f'Server error: {str(e)}'}), 500
+
+@app.route('/api/tts/audio/<key>', methods=['GET'])
+@limiter.exempt  # Served from cache only, never reaches Google
+def get_cached_audio(key):
+    """Serve a cached clip by its content-addressed key.
+
+    Responses carry a strong ETag and an immutable Cache-Control, and support
+    conditional and byte-range requests so replays and seeking stay local.
+    """
+    if not re.fullmatch(r'[0-9a-f]{64}', key):
+        return jsonify({'error': 'Invalid audio key'}), 400
+
+    entry = tts_cache.get_entry(key)
+    if entry is None:
+        return jsonify({'error': 'Audio not found'}), 404
+
+    audio, meta = entry
+    audio_format = AUDIO_FORMATS[meta.get('encoding', 'MP3')]
+    # send_file answers If-None-Match with 304 and Range with 206 when conditional is set
+    response = send_file(
+        io.BytesIO(audio),
+        mimetype=audio_format['mimetype'],
+        download_name=f"{key}.{audio_format['extension']}",
+        conditional=True,
+        etag=meta.get('etag') or audio_etag(audio),
+        max_age=TTS_STATIC_MAX_AGE
+    )
+    response.cache_control.immutable = True
+    return response
+
+@app.route('/api/tts/prerendered', methods=['GET'])
+def get_prerendered_audio():
+    """List the curated practice clips that are currently cached, with the URLs they are served from."""
+    if tts_backend is None:
+        logger.error("No TTS backend available")
+        return jsonify({'error': 'Text-to-speech service unavailable'}), 503
+
+    try:
+        clips = []
+        seen = set()
+        for params in warmup_params(load_warmup_manifest()):
+            key = tts_cache_key(params)
+            # Backends may collapse encodings onto the same clip; evicted clips would 404
+            if key in seen or not tts_cache.contains(key):
+                continue
+            seen.add(key)
+            clips.append({
+                'text': params.text,
+                'voiceId': params.voice_id,
+                'speed': params.speed,
+                'encoding': params.encoding,
+                'url': f"/api/tts/audio/{key}"
+            })
+        return jsonify({'clips': clips})
+    except Exception as e:
+        logger.error(f"Error in get_prerendered_audio: {str(e)}")
+        return jsonify({'error': f'Server error: {str(e)}'}), 500
+
 @app.route('/api/voices', methods=['GET'])
+@limiter.exempt  # Served from the in-memory catalog; the backend is only hit on refresh
 def get_voices():
-    if client is None:
-        logger.error("Google Cloud TTS client not initialized")
+    if tts_backend is None:
+        logger.error("No TTS backend available")
         return jsonify({'error': 'Voice service unavailable'}), 503
     
     try:
-        logger.info("Retrieving available voices from Google TTS API")
         try:
-            response = client.list_voices()
+            catalog = voice_catalog.get()
         except exceptions.GoogleAPICallError as e:
             logger.error(f"Google API call error: {str(e)}")
             return jsonify({'error': f'Failed to retrieve voices: {str(e)}'}), 500
         
-        voices = []
-        for voice in response.voices:
-            if any(lang_code.startswith('en-') for lang_code in voice.language_codes):
-                if voice.ssml_gender == texttospeech.SsmlVoiceGender.MALE:
-                    gender = "Male"
-                elif voice.ssml_gender == texttospeech.SsmlVoiceGender.FEMALE:
-                    gender = "Female"
-                else:
-                    gender = "Neutral"
-                
-                language_code = voice.language_codes[0]
-                if language_code == "en-US":
-                    accent = "American"
-                elif language_code == "en-GB":
-                    accent = "British"
-                elif language_code == "en-AU":
-                    accent = "Australian"
-                elif language_code == "en-IN":
-                    accent = "Indian"
-                else:
-                    accent = language_code
-                
-                voices.append({
-                    "id": voice.name,
-                    "name": voice.name.split('-')[-1],
-                    "accent": accent,
-                    "gender": gender,
-                    "language": language_code
-                })
-        
-        if not voices:
+        if not catalog['voices']:
             logger.warning("No English voices found in API response")
             return jsonify({'warning': 'No English voices available', 'voices': []}), 200
-            
-        logger.info(f"Successfully retrieved {len(voices)} voices")
-        return jsonify(voices)
+
+        filters = {field: request.args[field] for field in VoiceCatalog.FILTERS if request.args.get(field)}
+        if filters:
+            body = json.dumps(voice_catalog.query(catalog, filters), separators=(',', ':'))
+            etag = hashlib.sha256(f"{catalog['etag']}:{sorted(filters.items())}".encode('utf-8')).hexdigest()[:32]
+        else:
+            body = catalog['body']
+            etag = catalog['etag']
+
+        response = Response(body, mimetype='application/json')
+        response.set_etag(etag)
+        response.cache_control.public = True
+        response.cache_control.max_age = 300
+        return response.make_conditional(request)
         
     except Exception as e:
         logger.error(f"Error in get_voices: {str(e)}")
@@ -250,196 +1589,1624 @@ def get_voices():
 
 
 @app.route('/api/summarize', methods=['POST'])
-@limiter.limit("10 per minute")  # Apply rate limiting
+@limiter.limit("10 per minute", deduct_when=used_upstream)  # Apply rate limiting
 def summarize_concept():
     try:
         data = request.get_json()
         if not data:
             return jsonify({'error': 'Invalid request: No JSON data'}), 400
-        text = data.get('text', '').strip()
-        if not text:
-            return jsonify({'error': 'Text is required'}), 400
-        level = data.get('level', 'medium')
-        if level not in ['high', 'medium', 'low']:
-            return jsonify({'error': 'Invalid compression level'}), 400
-        if len(text) < 50:
-             return jsonify({'error': 'Text too short. Minimum 50 characters required.'}), 400
-
-        # --- Prioritize Gemini ---
-        if gemini_available:
+        text, level, error = parse_summarize_request(data)
+        if error:
+            return jsonify({'error': error}), 400
+        all_levels = bool(data.get('allLevels', False))
+
+        long_text = bool(data.get('longText', False))
+
+        result, engine, cached = summarize_text(text, level, all_levels, long_text, deadline=SUMMARY_DEADLINE)
+        response = jsonify(result)
+        response.headers['X-Cache'] = 'HIT' if cached else 'MISS'
+        response.headers['X-Summary-Engine'] = engine
+        return response
+
+    except Exception as e:
+        logger.error(f"Error in summarize_concept: {str(e)}")
+        logger.error(traceback.format_exc())
+        return jsonify({'error': f'Server error: {str(e)}'}), 500
+
+
+@app.route('/api/summarize/stream', methods=['POST'])
+@limiter.limit("10 per minute", deduct_when=used_upstream)  # Apply rate limiting
+def summarize_concept_stream():
+    """Stream summary fields as Server-Sent Events as soon as each one completes."""
+    try:
+        data = request.get_json()
+        if not data:
+            return jsonify({'error': 'Invalid request: No JSON data'}), 400
+        text, level, error = parse_summarize_request(data)
+        if error:
+            return jsonify({'error': error}), 400
+
+        engine = 'gemini' if gemini_available else 'nltk'
+        cached = summary_cache.contains(text, level, engine)
+        events = stream_summary_events(text, level, bool(data.get('longText', False)))
+
+        def generate():
             try:
-                summary, key_concepts, focus_points, related_topics = generate_concepts_with_gemini(text, level)  # Pass level
-                logger.info("Successfully generated summary and concepts with Gemini")
-                return jsonify({
-                    "summary": summary,
-                    "keyConcepts": key_concepts,
-                    "learningEnhancement": {
-                        "focusPoints": focus_points,
-                        "suggestedRelatedTopics": related_topics
-                    }
-                })
+                yield from events
             except Exception as e:
-                logger.error(f"Error with Gemini API: {str(e)}. Falling back to NLTK.")
-                # Fallback to NLTK is handled below
+                logger.error(f"Error mid-stream in summarize_concept_stream: {str(e)}")
+                yield sse_event('error', {'error': 'Summarization failed'})
 
-        # --- NLTK Fallback ---
-        logger.info("Using NLTK for summarization and concept extraction")
-        summary = generate_summary(text, level)
-        key_concepts = extract_key_concepts(text)
-        focus_points = generate_focus_points(text, key_concepts)
-        related_topics = generate_related_topics(text, key_concepts)
+        response = Response(stream_with_context(generate()), mimetype='text/event-stream')
+        response.headers['Cache-Control'] = 'no-cache'
+        response.headers['X-Accel-Buffering'] = 'no'  # Keep reverse proxies from buffering the stream
+        response.headers['X-Cache'] = 'HIT' if cached else 'MISS'
+        return response
+
+    except Exception as e:
+        logger.error(f"Error in summarize_concept_stream: {str(e)}")
+        logger.error(traceback.format_exc())
+        return jsonify({'error': f'Server error: {str(e)}'}), 500
+
+
+@app.route('/api/summarize/batch', methods=['POST'])
+@limiter.limit("10 per minute")  # Apply rate limiting
+def summarize_concept_batch():
+    """Summarize many documents in one request, reporting success or failure per document."""
+    try:
+        data = request.get_json()
+        if not data:
+            return jsonify({'error': 'Invalid request: No JSON data'}), 400
+
+        documents = data.get('documents')
+        if not isinstance(documents, list) or not documents:
+            return jsonify({'error': 'documents must be a non-empty list'}), 400
+        if len(documents) > SUMMARY_BATCH_MAX_ITEMS:
+            return jsonify({'error': f'A batch may contain at most {SUMMARY_BATCH_MAX_ITEMS} documents'}), 400
+
+        try:
+            parallelism = int(data.get('parallelism', SUMMARY_BATCH_PARALLELISM))
+        except (TypeError, ValueError):
+            return jsonify({'error': 'parallelism must be an integer'}), 400
+        parallelism = max(1, min(parallelism, SUMMARY_BATCH_PARALLELISM))
+
+        logger.info(f"Processing summary batch: {len(documents)} documents, parallelism={parallelism}")
+        results = map_bounded(summary_batch_executor, summarize_batch_item, documents, parallelism)
+        for index, result in enumerate(results):
+            result['index'] = index
+
+        failed = sum(1 for result in results if result['status'] == 'error')
+        logger.info(f"Summary batch finished: {len(results) - failed} succeeded, {failed} failed")
         return jsonify({
-            "summary": summary,
-            "keyConcepts": key_concepts,
-            "learningEnhancement": {
-                "focusPoints": focus_points,
-                "suggestedRelatedTopics": related_topics
-            }
+            'results': results,
+            'succeeded': len(results) - failed,
+            'failed': failed
         })
 
     except Exception as e:
-        logger.error(f"Error in summarize_concept: {str(e)}")
+        logger.error(f"Error in summarize_concept_batch: {str(e)}")
+        logger.error(traceback.format_exc())
+        return jsonify({'error': f'Server error: {str(e)}'}), 500
+
+
+@app.route('/api/summarize/jobs', methods=['POST'])
+@limiter.limit("10 per minute")  # Apply rate limiting
+def submit_summary_job():
+    """Queue a summarization job and return its id without waiting for the result."""
+    if not summary_jobs.available or SUMMARY_JOB_WORKERS <= 0:
+        return jsonify({'error': 'Summary jobs are unavailable'}), 503
+
+    try:
+        data = request.get_json()
+        if not data:
+            return jsonify({'error': 'Invalid request: No JSON data'}), 400
+        text, level, error = parse_summarize_request(data)
+        if error:
+            return jsonify({'error': error}), 400
+
+        job_id = summary_jobs.submit({
+            'text': text,
+            'level': level,
+            'allLevels': bool(data.get('allLevels', False)),
+            'longText': bool(data.get('longText', False)),
+        })
+        logger.info(f"Queued summary job {job_id}")
+        status_url = f"/api/summarize/jobs/{job_id}"
+        response = jsonify({'jobId': job_id, 'status': 'queued', 'statusUrl': status_url})
+        response.status_code = 202
+        response.headers['Location'] = status_url
+        return response
+
+    except Exception as e:
+        logger.error(f"Error in submit_summary_job: {str(e)}")
+        logger.error(traceback.format_exc())
+        return jsonify({'error': f'Server error: {str(e)}'}), 500
+
+@app.route('/api/summarize/jobs/<job_id>', methods=['GET'])
+@limiter.exempt  # Polling reads the job table only
+def get_summary_job(job_id):
+    """Report a job's status; with ?wait=N, hold the request up to N seconds for it to finish."""
+    if not summary_jobs.available:
+        return jsonify({'error': 'Summary jobs are unavailable'}), 503
+
+    try:
+        try:
+            wait_seconds = float(request.args.get('wait', 0))
+        except ValueError:
+            return jsonify({'error': 'wait must be a number'}), 400
+        wait_seconds = max(0.0, min(wait_seconds, SUMMARY_JOB_MAX_WAIT))
+
+        job = summary_jobs.wait(job_id, wait_seconds) if wait_seconds else summary_jobs.get(job_id)
+        if job is None:
+            return jsonify({'error': 'Unknown job'}), 404
+        return jsonify(job)
+
+    except Exception as e:
+        logger.error(f"Error in get_summary_job: {str(e)}")
         logger.error(traceback.format_exc())
         return jsonify({'error': f'Server error: {str(e)}'}), 500
 
 
 # --- Helper Functions ---
 
-def generate_concepts_with_gemini(text, level):
-    """Use Gemini API for summarization, key concepts, and learning enhancement.
-        Now includes summarization and handles level.
+
+def parse_summarize_request(data):
+    """Validate a summarize request body; returns (text, level, error_msg)."""
+    text = data.get('text', '').strip()
+    if not text:
+        return None, None, 'Text is required'
+    level = data.get('level', 'medium')
+    if level not in SUMMARY_LEVELS:
+        return None, None, 'Invalid compression level'
+    if len(text) < 50:
+        return None, None, 'Text too short. Minimum 50 characters required.'
+    return text, level, None
+
+
+def parse_tts_request(data, accept_mimetypes=None):
+    """Validate a TTS request body.
+
+    The encoding comes from the 'encoding' field, else from the Accept header
+    when accept_mimetypes is given, else defaults to MP3.
+    Returns (params, None) on success or (None, error_message) on failure.
     """
+    if not isinstance(data.get('text'), str) or not data['text'].strip():
+        logger.warning("Missing or empty 'text' field in request")
+        return None, 'Text is required'
+
+    text = data.get('text', '').strip()
+    voice_id = data.get('voiceId', 'en-US-Standard-D')  # Default
+
     try:
-        # --- Construct the prompt ---
-        prompt = f"""
-        Please analyze this text and provide:
-        1. A summary of the text.  The summary should be concise but comprehensive.
-           - If the 'level' is 'high', aim for a very short summary (1-2 sentences).
-           - If the 'level' is 'medium', aim for a moderate-length summary (3-4 sentences).
-           - If the 'level' is 'low', you can provide a more detailed summary (5-7 sentences).
-        2. 6 key concepts as brief phrases (2-5 words each).
-        3. 3 learning focus points (1 sentence each).
-        4. 4 related topics that would complement this knowledge (short phrases).
+        speed = float(data.get('speed', 1.0))
+        if speed < 0.25 or speed > 4.0:
+            logger.warning(f"Speed value out of range: {speed}")
+            return None, 'Speed must be between 0.25 and 4.0'
+    except (TypeError, ValueError):
+        logger.warning(f"Invalid speed value: {data.get('speed')}")
+        return None, 'Speed must be a valid number'
 
-        Format your response as JSON with these exact keys:
-        "summary", "keyConcepts", "focusPoints", "relatedTopics"
+    try:
+        language_code = '-'.join(voice_id.split('-')[:2])
+        if not language_code or len(language_code.split('-')) != 2:
+            raise ValueError("Invalid voice ID format")
+    except Exception:
+        logger.warning(f"Invalid voice ID format: {voice_id}")
+        return None, 'Invalid voice ID format'
+
+    encoding, error = negotiate_encoding(data, accept_mimetypes)
+    if error:
+        return None, error
+    if encoding not in tts_backend.encodings:
+        encoding = tts_backend.encodings[0]
+    if encoding == 'OGG_OPUS' and len(text.encode('utf-8')) > GOOGLE_TTS_MAX_INPUT_BYTES:
+        # Text this long is synthesized in segments, and joined Ogg segments form a
+        # chained stream that browsers (notably Chromium) play unreliably
+        logger.info("Text needs several synthesis requests; using MP3 instead of Ogg Opus")
+        encoding = 'MP3'
+
+    sample_rate = data.get('sampleRate')
+    if sample_rate is not None:
+        try:
+            sample_rate = int(sample_rate)
+            if sample_rate < 8000 or sample_rate > 48000:
+                return None, 'Sample rate must be between 8000 and 48000'
+        except (TypeError, ValueError):
+            return None, 'Sample rate must be an integer'
+
+    logger.info(f"Processing TTS request: language={language_code}, voice={voice_id}, speed={speed}, encoding={encoding}")
+    params = TTSParams(
+        text=normalize_tts_text(text),
+        voice_id=voice_id,
+        language_code=language_code,
+        speed=speed,
+        encoding=encoding,
+        sample_rate=sample_rate,
+        backend=tts_backend.name
+    )
+    return params, None
+
+
+def negotiate_encoding(data, accept_mimetypes=None):
+    """Pick the audio encoding for a request; returns (encoding, error_message)."""
+    requested = data.get('encoding')
+    if requested is not None:
+        encoding = ENCODING_ALIASES.get(str(requested).lower())
+        if encoding is None:
+            return None, f"Unsupported encoding. Choose one of: {', '.join(sorted(ENCODING_ALIASES))}"
+        return encoding, None
+
+    if accept_mimetypes:
+        best = accept_mimetypes.best_match([fmt['mimetype'] for fmt in AUDIO_FORMATS.values()])
+        for encoding, fmt in AUDIO_FORMATS.items():
+            if fmt['mimetype'] == best:
+                return encoding, None
+
+    return 'MP3', None
+
+
+def timed_audio_response(params):
+    """Synthesize params with word marks and return the audio and word offsets as one JSON body."""
+    if not tts_backend.supports_marks:
+        return jsonify({'error': f"Word timing is not supported by the '{tts_backend.name}' TTS backend"}), 501
+    params = params._replace(word_marks=True)
+    ssml, words = build_marked_ssml(params.text)
+    if len(ssml.encode('utf-8')) > GOOGLE_TTS_MAX_INPUT_BYTES:
+        return jsonify({'error': 'Text is too long for word timing; send one sentence at a time'}), 400
 
-        Compression Level: {level}
+    try:
+        audio_content, meta, cached = get_tts_entry(params)
+    except exceptions.GoogleAPICallError as e:
+        logger.error(f"Google API call error: {str(e)}")
+        return jsonify({'error': f'Text-to-speech API error: {str(e)}'}), 500
+
+    if not audio_content:
+        logger.error("No audio content in Google TTS response")
+        return jsonify({'error': 'No audio generated'}), 500
+
+    response = jsonify({
+        'audio': base64.b64encode(audio_content).decode('ascii'),
+        'mimeType': AUDIO_FORMATS[params.encoding]['mimetype'],
+        'url': f"/api/tts/audio/{tts_cache_key(params)}",
+        'words': word_offsets(words, meta.get('timepoints', [])),
+        'cached': cached
+    })
+    response.headers['X-Cache'] = 'HIT' if cached else 'MISS'
+    return response
+
+
+def build_marked_ssml(text):
+    """Wrap text in SSML with a <mark> before every word and one after the last.
+
+    Returns (ssml, words); mark "w<i>" precedes words[i] and mark "end" follows the text.
+    """
+    words = text.split()
+    body = ' '.join(f'<mark name="w{i}"/>{xml_escape(word)}' for i, word in enumerate(words))
+    return f'<speak>{body} <mark name="end"/></speak>', words
 
-        Text to analyze:
-        {text}
-        """
 
-        response = gemini_model.generate_content(prompt)
+def word_offsets(words, timepoints):
+    """Turn mark timepoints into a list of {word, start, end} offsets in seconds."""
+    times = {tp['name']: tp['time'] for tp in timepoints}
+    offsets = []
+    for i, word in enumerate(words):
+        start = times.get(f"w{i}")
+        end = times.get(f"w{i + 1}", times.get('end'))
+        if start is None or end is None:
+            continue
+        offsets.append({'word': word, 'start': round(start, 3), 'end': round(end, 3)})
+    return offsets
+
 
-        # --- Parse the response (with robust error handling) ---
+def synthesize_with_google(params):
+    """Make a single synthesize_speech call for params.
+
+    Returns (audio, meta); meta holds the mark timepoints when params.word_marks is set.
+    """
+    if params.word_marks:
+        return synthesize_with_marks(params)
+
+    logger.info("Calling Google TTS API")
+    runner = get_async_tts()
+    if runner is not None:
+        response = runner.run(runner.synthesize(google_synthesis_request(params))).result()
+    else:
+        response = client.synthesize_speech(request=google_synthesis_request(params))
+    logger.info("Successfully received TTS response")
+    return response.audio_content, {}
+
+
+def google_synthesis_request(params):
+    """Build the v1 SynthesizeSpeechRequest for params."""
+    return texttospeech.SynthesizeSpeechRequest(
+        input=texttospeech.SynthesisInput(text=params.text),
+        voice=texttospeech.VoiceSelectionParams(
+            language_code=params.language_code,
+            name=params.voice_id
+        ),
+        audio_config=texttospeech.AudioConfig(
+            audio_encoding=texttospeech.AudioEncoding[params.encoding],
+            speaking_rate=params.speed,
+            sample_rate_hertz=params.sample_rate or 0  # 0 lets Google pick the voice's native rate
+        )
+    )
+
+
+def synthesize_with_marks(params):
+    """Synthesize params.text as marked SSML through the v1beta1 API to get word timepoints."""
+    if beta_client is None:
+        raise RuntimeError("Word timing requires the Google Cloud TTS v1beta1 client")
+
+    ssml, _ = build_marked_ssml(params.text)
+    request_body = texttospeech_v1beta1.SynthesizeSpeechRequest(
+        input=texttospeech_v1beta1.SynthesisInput(ssml=ssml),
+        voice=texttospeech_v1beta1.VoiceSelectionParams(
+            language_code=params.language_code,
+            name=params.voice_id
+        ),
+        audio_config=texttospeech_v1beta1.AudioConfig(
+            audio_encoding=texttospeech_v1beta1.AudioEncoding[params.encoding],
+            speaking_rate=params.speed,
+            sample_rate_hertz=params.sample_rate or 0
+        ),
+        enable_time_pointing=[texttospeech_v1beta1.SynthesizeSpeechRequest.TimepointType.SSML_MARK]
+    )
+
+    logger.info("Calling Google TTS API with SSML marks")
+    response = beta_client.synthesize_speech(request=request_body)
+    logger.info(f"Successfully received TTS response with {len(response.timepoints)} timepoints")
+    timepoints = [{'name': tp.mark_name, 'time': tp.time_seconds} for tp in response.timepoints]
+    return response.audio_content, {'timepoints': timepoints}
+
+
+def split_sentences(text):
+    """Split text into sentences with punkt, falling back to punctuation if it is missing."""
+    try:
+        sentences = sent_tokenize(text)
+    except LookupError:
+        logger.warning("punkt tokenizer unavailable, splitting sentences on punctuation")
+        sentences = re.split(r'(?<=[.!?])\s+', text)
+    return [sentence.strip() for sentence in sentences if sentence.strip()]
+
+
+def split_tts_units(text, max_bytes=GOOGLE_TTS_MAX_INPUT_BYTES):
+    """Split text into sentences, breaking any sentence over max_bytes at word boundaries."""
+    units = []
+    for sentence in split_sentences(text):
+        if len(sentence.encode('utf-8')) <= max_bytes:
+            units.append(sentence)
+            continue
+        current = ''
+        for word in sentence.split():
+            candidate = f"{current} {word}" if current else word
+            if current and len(candidate.encode('utf-8')) > max_bytes:
+                units.append(current)
+                current = word
+            else:
+                current = candidate
+        if current:
+            units.append(current)
+    return units
+
+
+def split_text_for_tts(text, max_bytes=TTS_CHUNK_BYTES):
+    """Pack whole sentences into chunks of at most max_bytes UTF-8 bytes."""
+    chunks = []
+    current = ''
+    for unit in split_tts_units(text, max_bytes):
+        candidate = f"{current} {unit}" if current else unit
+        if current and len(candidate.encode('utf-8')) > max_bytes:
+            chunks.append(current)
+            current = unit
+        else:
+            current = candidate
+    if current:
+        chunks.append(current)
+    return chunks
+
+
+def strip_id3_tag(audio):
+    """Remove a leading ID3v2 tag so MP3 segments can be concatenated frame to frame."""
+    if len(audio) >= 10 and audio[:3] == b'ID3':
+        size = (audio[6] << 21) | (audio[7] << 14) | (audio[8] << 7) | audio[9]
+        footer = 10 if audio[5] & 0x10 else 0
+        return audio[10 + size + footer:]
+    return audio
+
+
+def split_wav(audio):
+    """Return (fmt_chunk, pcm) for a RIFF/WAVE file, or (None, audio) if it has no header."""
+    if audio[:4] != b'RIFF' or audio[8:12] != b'WAVE':
+        return None, audio
+    fmt = None
+    pcm = []
+    pos = 12
+    while pos + 8 <= len(audio):
+        chunk_id = audio[pos:pos + 4]
+        size = struct.unpack('<I', audio[pos + 4:pos + 8])[0]
+        body = audio[pos + 8:pos + 8 + size]
+        if chunk_id == b'fmt ':
+            fmt = body
+        elif chunk_id == b'data':
+            pcm.append(body)
+        pos += 8 + size + (size & 1)
+    return fmt, b''.join(pcm)
+
+
+def build_wav(fmt, pcm, data_size=None):
+    """Wrap raw PCM in a RIFF/WAVE header; data_size overrides the length for streaming."""
+    data_size = len(pcm) if data_size is None else data_size
+    riff_size = min(4 + 8 + len(fmt) + 8 + data_size, 0xFFFFFFFF)
+    return (
+        b'RIFF' + struct.pack('<I', riff_size) + b'WAVE'
+        + b'fmt ' + struct.pack('<I', len(fmt)) + fmt
+        + b'data' + struct.pack('<I', data_size) + pcm
+    )
+
+
+def join_audio_segments(segments, encoding='MP3'):
+    """Join independently synthesized segments into one continuous stream.
+
+    MP3 frames concatenate once the ID3 tags are dropped and WAV segments are
+    merged under a single header. Ogg Opus is never segmented (see
+    get_tts_audio), so it only ever reaches here as a single segment.
+    """
+    if not segments:
+        return b''
+    if encoding == 'MP3':
+        return segments[0] + b''.join(strip_id3_tag(segment) for segment in segments[1:])
+    if encoding == 'LINEAR16':
+        fmt, _ = split_wav(segments[0])
+        if fmt is not None:
+            return build_wav(fmt, b''.join(split_wav(segment)[1] for segment in segments))
+    return b''.join(segments)
+
+
+def stream_chunk(segment, encoding, first):
+    """Convert one synthesized segment into the bytes appended to a streamed response."""
+    if encoding == 'MP3':
+        return segment if first else strip_id3_tag(segment)
+    if encoding == 'LINEAR16':
+        fmt, pcm = split_wav(segment)
+        if first and fmt is not None:
+            return build_wav(fmt, pcm, data_size=0xFFFFFFFF)  # Total length is not known yet
+        return pcm
+    return segment
+
+
+def synthesize_chunked(params, chunks):
+    """Synthesize chunks concurrently and join them in order.
+
+    Each chunk goes through the cache on its own, so the result is (audio, cached)
+    where cached is True only if no chunk needed a Google call.
+    """
+    futures = [submit_tts(params._replace(text=chunk)) for chunk in chunks]
+    results = [future.result() for future in futures]
+    audio = join_audio_segments([segment for segment, _ in results], params.encoding)
+    synthesized = sum(1 for _, cached in results if not cached)
+    logger.info(f"Joined {len(chunks)} segments, {synthesized} freshly synthesized")
+    return audio, synthesized == 0
+
+
+def iter_tts_segments(params, units):
+    """Yield the audio for each unit in order, synthesizing a bounded window ahead.
+
+    The first segment is available after a single synthesis round trip; later ones
+    are usually already finished by the time the client has played the earlier ones.
+    Closing the generator cancels any synthesis that has not started yet.
+    """
+    pending = []
+    next_unit = 0
+    try:
+        while next_unit < len(units) or pending:
+            while next_unit < len(units) and len(pending) < TTS_MAX_WORKERS:
+                pending.append(submit_tts(params._replace(text=units[next_unit])))
+                next_unit += 1
+            audio, _ = pending.pop(0).result()
+            yield audio
+    finally:
+        for future in pending:
+            future.cancel()
+
+
+def map_bounded(executor, fn, items, limit):
+    """Apply fn to every item on executor with at most limit calls in flight; keeps order."""
+    futures = {}
+    results = [None] * len(items)
+    next_item = 0
+    while next_item < len(items) or futures:
+        while next_item < len(items) and len(futures) < limit:
+            futures[executor.submit(fn, items[next_item])] = next_item
+            next_item += 1
+        done, _ = wait(futures, return_when=FIRST_COMPLETED)
+        for future in done:
+            results[futures.pop(future)] = future.result()
+    return results
+
+
+def synthesize_batch_item(item):
+    """Synthesize one batch item, turning any failure into an error result."""
+    try:
+        if not isinstance(item, dict):
+            return {'status': 'error', 'error': 'Item must be an object'}
+        params, error = parse_tts_request(item)
+        if error:
+            return {'status': 'error', 'error': error}
+
+        audio, cached = get_tts_audio(
+            params,
+            long_text=bool(item.get('longText', False)),
+            incremental=bool(item.get('incremental', TTS_SENTENCE_UNITS))
+        )
+        if not audio:
+            return {'status': 'error', 'error': 'No audio generated'}
+        return {
+            'status': 'ok',
+            'audio': base64.b64encode(audio).decode('ascii'),
+            'mimeType': AUDIO_FORMATS[params.encoding]['mimetype'],
+            'cached': cached
+        }
+    except exceptions.GoogleAPICallError as e:
+        logger.error(f"Google API call error in batch item: {str(e)}")
+        return {'status': 'error', 'error': f'Text-to-speech API error: {str(e)}'}
+    except Exception as e:
+        logger.error(f"Error synthesizing batch item: {str(e)}")
+        return {'status': 'error', 'error': f'Server error: {str(e)}'}
+
+
+def load_warmup_manifest(path=None):
+    """Read the warm-up manifest of phrases, voices and speeds."""
+    path = path or TTS_WARMUP_MANIFEST
+    try:
+        with open(path, encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError) as e:
+        logger.error(f"Failed to load TTS warm-up manifest {path}: {str(e)}")
+        return {}
+
+
+def warmup_params(manifest):
+    """Expand a manifest into TTSParams for every phrase x voice x speed x encoding."""
+    params = []
+    for phrase in manifest.get('phrases', []):
+        for voice_id in manifest.get('voices', ['en-US-Standard-D']):
+            for speed in manifest.get('speeds', [1.0]):
+                for encoding in manifest.get('encodings', ['mp3']):
+                    item, error = parse_tts_request(
+                        {'text': phrase, 'voiceId': voice_id, 'speed': speed, 'encoding': encoding}
+                    )
+                    if error:
+                        logger.warning(f"Skipping warm-up entry ({phrase!r}, {voice_id}, {speed}, {encoding}): {error}")
+                        continue
+                    params.append(item)
+    return params
+
+
+def warm_tts_cache(manifest):
+    """Pre-synthesize every manifest entry into the audio cache."""
+    params = warmup_params(manifest)
+
+    def warm(item):
+        try:
+            _, cached = get_tts_audio(item)
+            return 'cached' if cached else 'synthesized'
+        except Exception as e:
+            logger.warning(f"Warm-up synthesis failed for {item.voice_id}: {str(e)}")
+            return 'failed'
+
+    outcome = Counter(map_bounded(tts_batch_executor, warm, params, TTS_BATCH_PARALLELISM))
+    logger.info(
+        f"TTS warm-up finished: {outcome['synthesized']} synthesized, "
+        f"{outcome['cached']} already cached, {outcome['failed']} failed"
+    )
+    return outcome
+
+
+def claim_warmup_lock():
+    """Create the cross-process warm-up lock file; False if another process holds it."""
+    for _ in range(2):
+        try:
+            fd = os.open(TTS_WARMUP_LOCK_PATH, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            try:
+                if time.time() - os.path.getmtime(TTS_WARMUP_LOCK_PATH) < TTS_WARMUP_LOCK_AGE:
+                    return False
+                os.remove(TTS_WARMUP_LOCK_PATH)
+            except OSError:
+                return False
+            continue
+        except OSError as e:
+            logger.warning(f"Failed to create TTS warm-up lock: {str(e)}")
+            return False
+        with os.fdopen(fd, 'w') as f:
+            f.write(str(os.getpid()))
+        return True
+    return False
+
+
+def start_tts_warmup():
+    """Warm the TTS cache in the background once per deployment, if enabled.
+
+    Every serving process calls this, but only the one that claims the lock file
+    runs the warm-up, so N workers do not make N times the upstream calls.
+    """
+    global tts_warmup_started
+    if tts_warmup_started or not TTS_WARMUP_ON_START or tts_backend is None:
+        return
+    with tts_warmup_lock:
+        if tts_warmup_started:
+            return
+        tts_warmup_started = True
+    if not claim_warmup_lock():
+        logger.info("TTS warm-up already running in another process")
+        return
+
+    def run():
+        try:
+            warm_tts_cache(load_warmup_manifest())
+        finally:
+            try:
+                os.remove(TTS_WARMUP_LOCK_PATH)
+            except OSError:
+                pass
+
+    threading.Thread(target=run, name='tts-warmup', daemon=True).start()
+
+
+def get_tts_audio(params, long_text=False, incremental=False):
+    """Return (audio, cached) for params, calling Google only on a cache miss.
+
+    Text over Google's input limit, or any text when long_text is set, is split at
+    sentence boundaries and the chunks are synthesized in parallel. With
+    incremental set every sentence is its own cache entry, so after a small edit
+    only the sentences that changed are synthesized again.
+
+    Ogg Opus is always a single request: text too long for one is switched to
+    MP3 by parse_tts_request, since chained Ogg streams play unreliably.
+    """
+    if params.encoding == 'OGG_OPUS':
+        long_text = incremental = False
+
+    if incremental:
+        units = split_tts_units(params.text)
+        if len(units) > 1:
+            return synthesize_chunked(params, units)
+
+    if long_text or len(params.text.encode('utf-8')) > GOOGLE_TTS_MAX_INPUT_BYTES:
+        chunks = split_text_for_tts(params.text)
+        if len(chunks) > 1:
+            return synthesize_chunked(params, chunks)
+
+    audio, _, cached = get_tts_entry(params)
+    return audio, cached
+
+
+def get_derived_speed_audio(params, long_text=False, incremental=False):
+    """Produce params.speed locally from a cached 1.0x LINEAR16 synthesis.
+
+    Only the base rendering reaches the backend, so moving the speed slider costs
+    a time-stretch instead of a network round trip, and each derived speed is
+    cached under its own key so a repeated step costs nothing. Chunked requests and
+    clips over TTS_DERIVE_MAX_SECONDS are synthesized at params.speed upstream.
+    Returns (audio, cached).
+    """
+    if long_text or incremental:
+        return get_tts_audio(params, long_text, incremental)
+
+    key = tts_cache_key(params)
+    entry = tts_cache.get_entry(key)
+    if entry is not None:
+        logger.info(f"Serving derived TTS audio from cache: {key[:12]}")
+        return entry[0], True
+
+    base_params = params._replace(speed=1.0, encoding='LINEAR16')
+    audio, _ = get_tts_audio(base_params)
+
+    fmt, pcm = split_wav(audio)
+    if fmt is None or struct.unpack('<HH', fmt[:4]) != (1, 1) or struct.unpack('<H', fmt[14:16])[0] != 16:
+        raise ValueError("Speed derivation needs 16-bit mono PCM")
+    sample_rate = struct.unpack('<I', fmt[4:8])[0]
+    if len(pcm) / 2 / sample_rate > TTS_DERIVE_MAX_SECONDS:
+        logger.info(f"Clip is over {TTS_DERIVE_MAX_SECONDS:g} s; synthesizing {params.speed}x upstream")
+        return get_tts_audio(params)
+
+    def derive():
+        # A flight for key may have finished between the lookup above and now
+        entry = tts_cache.get_entry(key)
+        if entry is not None:
+            return entry[0], entry[1], True
+        started = time.perf_counter()
+        samples = np.frombuffer(pcm, dtype='<i2').astype(np.float32)
+        stretched = time_stretch(samples, params.speed)
+        derived = build_wav(fmt, np.clip(np.round(stretched), -32768, 32767).astype('<i2').tobytes())
+        logger.info(f"Derived {params.speed}x audio locally in {(time.perf_counter() - started) * 1000:.1f} ms")
+        return derived, store_tts_entry(key, params, derived, {}), False
+
+    (derived, _, cached), shared = tts_singleflight.do(key, derive)
+    return derived, shared or cached
+
+
+def time_stretch(samples, rate, n_fft=1024, hop=256):
+    """Pitch-preserving time stretch with a vectorized phase vocoder.
+
+    rate > 1 shortens the audio (faster speech), rate < 1 lengthens it.
+    hop must divide n_fft.
+    """
+    if len(samples) == 0:
+        return samples
+    window = np.hanning(n_fft).astype(np.float32)
+    padded = np.concatenate([np.zeros(n_fft // 2, np.float32), samples, np.zeros(n_fft, np.float32)])
+    n_frames = 1 + (len(padded) - n_fft) // hop
+    frame_index = np.arange(n_fft)[None, :] + hop * np.arange(n_frames)[:, None]
+    spectrum = np.fft.rfft(padded[frame_index] * window, axis=1)
+
+    # Sample the spectrogram at fractional frame positions, interpolating magnitude
+    steps = np.arange(0, n_frames - 1, rate)
+    left = np.floor(steps).astype(int)
+    fraction = (steps - left)[:, None]
+    magnitude = (1 - fraction) * np.abs(spectrum[left]) + fraction * np.abs(spectrum[left + 1])
+
+    # Accumulate phase from each bin's true frequency so partials stay coherent
+    expected = 2 * np.pi * hop * np.arange(n_fft // 2 + 1) / n_fft
+    deviation = np.angle(spectrum[left + 1]) - np.angle(spectrum[left]) - expected
+    deviation -= 2 * np.pi * np.round(deviation / (2 * np.pi))
+    advance = expected + deviation
+    phase = np.angle(spectrum[0]) + np.vstack([np.zeros((1, advance.shape[1])), np.cumsum(advance[:-1], axis=0)])
+
+    frames = np.fft.irfft(magnitude * np.exp(1j * phase), n=n_fft, axis=1) * window
+
+    # Overlap-add: hop divides n_fft, so each hop-wide column of the frames is one
+    # contiguous run of the output and the whole sum takes n_fft // hop slices.
+    overlap = n_fft // hop
+    output = np.zeros(hop * (len(steps) + overlap - 1))
+    norm = np.zeros_like(output)
+    window_sq = np.broadcast_to(window ** 2, frames.shape)
+    for k in range(overlap):
+        output[k * hop:k * hop + hop * len(steps)] += frames[:, k * hop:(k + 1) * hop].reshape(-1)
+        norm[k * hop:k * hop + hop * len(steps)] += window_sq[:, k * hop:(k + 1) * hop].reshape(-1)
+    nonzero = norm > 1e-3
+    output[nonzero] /= norm[nonzero]
+
+    target_length = int(round(len(samples) / rate))
+    return output[n_fft // 2:n_fft // 2 + target_length]
+
+
+def audio_etag(audio):
+    """Strong ETag for a clip, derived from its bytes."""
+    return hashlib.sha256(audio).hexdigest()[:32]
+
+
+def get_tts_entry(params):
+    """Return (audio, meta, cached) for a single synthesis request, using the cache.
+
+    Identical requests already in flight are joined rather than repeated; cached
+    is True whenever this caller did not trigger a Google call of its own.
+    """
+    key = tts_cache_key(params)
+    entry = tts_cache.get_entry(key)
+    if entry is not None:
+        logger.info(f"Serving TTS audio from cache: {key[:12]}")
+        return entry[0], entry[1], True
+
+    def synthesize():
+        # A flight for key may have finished between the lookup above and now
+        entry = tts_cache.get_entry(key)
+        if entry is not None:
+            return entry[0], entry[1], True
+        audio, meta = tts_backend.synthesize(params)
+        return audio, store_tts_entry(key, params, audio, meta), False
+
+    (audio, meta, cached), shared = tts_singleflight.do(key, synthesize)
+    if shared:
+        logger.info(f"Joined in-flight TTS synthesis: {key[:12]}")
+    return audio, meta, shared or cached
+
+
+def store_tts_entry(key, params, audio, meta):
+    """Cache freshly synthesized audio and return the metadata stored with it."""
+    meta = dict(meta, encoding=params.encoding, etag=audio_etag(audio))
+    tts_cache.put(key, audio, meta)
+    return meta
+
+
+def submit_tts(params):
+    """Start synthesizing a single request and return a Future of (audio, cached).
+
+    With the async client the Google call is multiplexed on its event loop and no
+    thread waits on it; otherwise the call runs on the chunk thread pool.
+    """
+    runner = get_async_tts()
+    if runner is None or params.word_marks or params.backend != 'google':
+        return tts_chunk_executor.submit(get_tts_audio, params)
+
+    key = tts_cache_key(params)
+    entry = tts_cache.get_entry(key)
+    if entry is not None:
+        future = Future()
+        future.set_result((entry[0], True))
+        return future
+
+    # Same result shape as the flight in get_tts_entry: both register under the
+    # same key in tts_singleflight, so either kind of caller may join either kind
+    async def synthesize():
+        # A flight for key may have finished between the lookup above and now
+        entry = await runner.offload(tts_cache.get_entry, key)
+        if entry is not None:
+            return entry[0], entry[1], True
+        response = await runner.synthesize(google_synthesis_request(params))
+        meta = await runner.offload(store_tts_entry, key, params, response.audio_content, {})
+        return response.audio_content, meta, False
+
+    upstream, shared = tts_singleflight.submit(key, lambda: runner.run(synthesize()))
+    result = Future()
+
+    def relay(done):
+        # Claims the Future atomically, so a concurrent cancel() can no longer win
+        if not result.set_running_or_notify_cancel():
+            return  # Cancelled by the caller, e.g. a closed stream
+        # Anything raised here would be swallowed by concurrent.futures and leave
+        # the caller waiting forever, so every failure is passed on
+        try:
+            audio, _, cached = done.result()
+        except BaseException as e:
+            result.set_exception(e)
+        else:
+            result.set_result((audio, shared or cached))
+
+    upstream.add_done_callback(relay)
+    return result
+
+
+def summarize_batch_item(item):
+    """Summarize one batch document, turning any failure into an error result."""
+    try:
+        if not isinstance(item, dict):
+            return {'status': 'error', 'error': 'Document must be an object'}
+        text, level, error = parse_summarize_request(item)
+        if error:
+            return {'status': 'error', 'error': error}
+
+        result, engine, cached = summarize_text(
+            text,
+            level,
+            all_levels=bool(item.get('allLevels', False)),
+            long_text=bool(item.get('longText', False))
+        )
+        return {'status': 'ok', 'result': result, 'engine': engine, 'cached': cached}
+    except Exception as e:
+        logger.error(f"Error summarizing batch document: {str(e)}")
+        return {'status': 'error', 'error': f'Server error: {str(e)}'}
+
+
+def run_summary_job_worker():
+    """Claim and run queued summary jobs until the process exits."""
+    while True:
         try:
-            result_text = response.text
-            if '{' in result_text and '}' in result_text:
-                json_str = result_text[result_text.find('{'):result_text.rfind('}') + 1]
-                result = json.loads(json_str)
-
-                summary = result.get("summary", "Could not generate summary.")  # Provide default
-                key_concepts = result.get("keyConcepts", [])[:6]
-                focus_points = result.get("focusPoints", [])[:3]
-                related_topics = result.get("relatedTopics", [])[:4]
-
-                return summary, key_concepts, focus_points, related_topics
-
-        except Exception as json_error:
-            logger.warning(f"Failed to parse JSON from Gemini: {str(json_error)}")
-            # Attempt fallback extraction (as in previous version)
-            #  ... (Code from previous version's fallback here) ...
-            content = response.text
-            sections = content.split('\n\n')
-            key_concepts = []
-            focus_points = []
-            related_topics = []
-            summary = None
-
-            for section in sections:
-                section_lower = section.lower()
-                if "summary" in section_lower:
-                    if summary is None:
-                        summary = section.replace("Summary:", "").strip()
-                if "key concept" in section_lower:
-                    lines = section.split('\n')
-                    key_concepts.extend([line.split(':', 1)[-1].split('-', 1)[-1].split('•', 1)[-1].strip() for line in lines if ':' in line or '-' in line or '•' in line])
-                elif "focus point" in section_lower or "learning point" in section_lower:
-                    lines = section.split('\n')
-                    focus_points.extend([line.split(':', 1)[-1].split('-', 1)[-1].split('•', 1)[-1].strip() for line in lines if ':' in line or '-' in line or '•' in line])
-                elif "related topic" in section_lower:
-                    lines = section.split('\n')
-                    related_topics.extend([line.split(':', 1)[-1].split('-', 1)[-1].split('•', 1)[-1].strip() for line in lines if ':' in line or '-' in line or '•' in line])
-
-            key_concepts = key_concepts[:6]
-            focus_points = focus_points[:3]
-            related_topics = related_topics[:4]
-
-            if summary is None:
-                summary = "Could not generate summary."
-
-            if not key_concepts:
-                key_concepts = ["No key concepts identified."] * 6
-            if not focus_points:
-                focus_points = ["No focus points identified."] * 3
-            if not related_topics:
-                related_topics = ["No related topics identified"] * 4
-
-            return summary, key_concepts, focus_points, related_topics
+            claimed = summary_jobs.claim()
+            if claimed is None:
+                summary_jobs.wait_for_work(1.0)  # Also picks up jobs queued by other processes
+                continue
+            job_id, job_request = claimed
+            heartbeat_stop = threading.Event()
+            threading.Thread(
+                target=renew_summary_job_lease,
+                args=(job_id, heartbeat_stop),
+                name=f'summary-job-lease-{job_id[:8]}',
+                daemon=True
+            ).start()
+            try:
+                result, engine, cached = summarize_text(
+                    job_request['text'],
+                    job_request['level'],
+                    all_levels=job_request.get('allLevels', False),
+                    long_text=job_request.get('longText', False)
+                )
+                summary_jobs.complete(job_id, {'result': result, 'engine': engine, 'cached': cached})
+                logger.info(f"Summary job {job_id} finished with {engine}")
+            except Exception as e:
+                logger.error(f"Summary job {job_id} failed: {str(e)}")
+                summary_jobs.fail(job_id, f'Server error: {str(e)}')
+            finally:
+                heartbeat_stop.set()
+        except Exception as e:
+            logger.error(f"Error in summary job worker: {str(e)}")
+            time.sleep(1.0)
+
+
+def renew_summary_job_lease(job_id, stop):
+    """Keep a running job's lease fresh so it is not handed to another worker"""
+    while not stop.wait(summary_jobs.lease / 3):
+        try:
+            summary_jobs.renew(job_id)
+        except sqlite3.Error as e:
+            logger.warning(f"Failed to renew lease for summary job {job_id}: {str(e)}")
+
+
+def start_summary_job_workers():
+    """Start this process's job workers once; safe to call from every request."""
+    global summary_job_workers_started
+    if summary_job_workers_started or not summary_jobs.available:
+        return
+    with summary_job_workers_lock:
+        if summary_job_workers_started:
+            return
+        for i in range(SUMMARY_JOB_WORKERS):
+            threading.Thread(target=run_summary_job_worker, name=f'summary-job-{i}', daemon=True).start()
+        summary_job_workers_started = True
+
+
+def summarize_text(text, level, all_levels=False, long_text=False, deadline=None):
+    """Summarize text with Gemini, falling back to NLTK, through the summary cache.
+
+    With all_levels, every compression level is produced in one pass and each
+    is cached, so switching levels afterwards is a cache hit; the result then
+    also carries a "summaries" map keyed by level. Text over
+    SUMMARY_MAP_REDUCE_TOKENS, or any text when long_text is set, is
+    summarized section by section and then reduced. With a deadline (in
+    seconds), Gemini races the NLTK pipeline; see race_gemini_with_nltk.
+
+    Returns (result, engine, cached) where result is the /api/summarize body.
+    """
+    levels = SUMMARY_LEVELS if all_levels else (level,)
+    long_text = long_text or estimate_tokens(text) > SUMMARY_MAP_REDUCE_TOKENS
+
+    if gemini_available:
+        results = get_cached_summaries(text, levels, 'gemini')
+        if results is not None:
+            return combine_summary_results(results, level, all_levels), 'gemini', True
+        if deadline:
+            results, engine, cached = race_gemini_with_nltk(text, levels, long_text, deadline)
+            return combine_summary_results(results, level, all_levels), engine, cached
+        try:
+            results = summarize_with_gemini(text, levels, long_text)
+            return combine_summary_results(results, level, all_levels), 'gemini', False
+        except Exception as e:
+            logger.error(f"Error with Gemini API: {str(e)}. Falling back to NLTK.")
+
+    results, cached = get_nltk_results(text, levels, long_text)
+    return combine_summary_results(results, level, all_levels), 'nltk', cached
+
+
+def summarize_with_gemini(text, levels, long_text=False):
+    """Run Gemini (map-reduce for long text), cache and return {level: result}."""
+    if long_text:
+        summaries, key_concepts, focus_points, related_topics = summarize_long_with_gemini(text, levels)
+    else:
+        summaries, key_concepts, focus_points, related_topics = generate_concepts_with_gemini(text, levels)
+    logger.info("Successfully generated summary and concepts with Gemini")
+    results = {
+        lvl: build_summary_result(summaries[lvl], key_concepts, focus_points, related_topics)
+        for lvl in levels
+    }
+    put_cached_summaries(text, results, 'gemini')
+    return results
+
+
+def get_nltk_results(text, levels, long_text=False):
+    """Return ({level: result}, cached) from the summary cache or a fresh NLTK run."""
+    results = get_cached_summaries(text, levels, 'nltk')
+    if results is not None:
+        return results, True
+
+    logger.info("Using NLTK for summarization and concept extraction")
+    results = summarize_with_nltk(text, levels, long_text)
+    put_cached_summaries(text, results, 'nltk')
+    return results, False
+
+
+def race_gemini_with_nltk(text, levels, long_text, deadline):
+    """Start Gemini in the background, run NLTK here, and take Gemini only if it meets the deadline.
+
+    A Gemini call that misses the deadline keeps running and caches its
+    result, so the next request for the same text gets it. When every race
+    worker is still busy with such calls, Gemini is skipped and NLTK answers
+    directly. Returns ({level: result}, engine, cached).
+    """
+    if not summary_race_slots.acquire(blocking=False):
+        summary_deadline_stats['skipped'] += 1
+        logger.warning("All Gemini race workers busy; returning NLTK result")
+        nltk_results, nltk_cached = get_nltk_results(text, levels, long_text)
+        return nltk_results, 'nltk', nltk_cached
+
+    started = time.monotonic()
+    gemini_future = summary_race_executor.submit(summarize_with_gemini, text, levels, long_text)
+    gemini_future.add_done_callback(lambda _: summary_race_slots.release())
+    nltk_results, nltk_cached = get_nltk_results(text, levels, long_text)
+    try:
+        results = gemini_future.result(timeout=max(0.0, deadline - (time.monotonic() - started)))
+        summary_deadline_stats['met'] += 1
+        return results, 'gemini', False
+    except FutureTimeoutError:
+        gemini_future.cancel()  # Only takes effect if the call never started
+        summary_deadline_stats['missed'] += 1
+        logger.warning(f"Gemini missed the {deadline}s deadline; returning NLTK result")
+    except Exception as e:
+        summary_deadline_stats['failed'] += 1
+        logger.error(f"Error with Gemini API: {str(e)}. Falling back to NLTK.")
+    return nltk_results, 'nltk', nltk_cached
+
+
+def get_cached_summaries(text, levels, engine):
+    """Return {level: result} if every level is cached for this engine, else None"""
+    results = {}
+    for lvl in levels:
+        result = summary_cache.get(text, lvl, engine)
+        if result is None:
+            return None
+        results[lvl] = result
+    return results
+
+
+def put_cached_summaries(text, results, engine):
+    for lvl, result in results.items():
+        summary_cache.put(text, lvl, engine, result)
+
 
+def combine_summary_results(results, level, all_levels):
+    result = dict(results[level])
+    if all_levels:
+        result['summaries'] = {lvl: results[lvl]['summary'] for lvl in SUMMARY_LEVELS}
+    return result
+
+
+def summarize_with_nltk(text, levels, long_text=False):
+    """Run the NLTK pipeline once and return {level: /api/summarize body}."""
+    if long_text:
+        text, key_concepts = nltk_reduce_input(text)
+    else:
+        key_concepts = extract_key_concepts(text)
+    summaries = generate_summaries(text, levels)
+    focus_points = generate_focus_points(text, key_concepts)
+    related_topics = generate_related_topics(text, key_concepts)
+    return {
+        lvl: build_summary_result(summaries[lvl], key_concepts, focus_points, related_topics)
+        for lvl in levels
+    }
+
+
+def estimate_tokens(text):
+    return len(text.encode('utf-8')) // SUMMARY_BYTES_PER_TOKEN
+
+
+def split_summary_sections(text, max_tokens=SUMMARY_SECTION_TOKENS):
+    """Pack whole sentences into sections of roughly max_tokens tokens."""
+    # Same packing as TTS chunking, just measured against a token budget
+    return split_text_for_tts(text, max_tokens * SUMMARY_BYTES_PER_TOKEN)
+
+
+def join_partial_summaries(partials):
+    """Build the reduce-step input from (section_summary, key_concepts) pairs."""
+    parts = []
+    for i, (summary, key_concepts) in enumerate(partials, 1):
+        parts.append(f"Section {i}: {summary}")
+        if key_concepts:
+            parts.append(f"Key concepts: {'; '.join(key_concepts)}")
+    return '\n'.join(parts)
+
+
+def gemini_reduce_input(text):
+    """Map step: summarize sections concurrently until the text fits one section.
+
+    Each round replaces the text with its section summaries and concepts, so
+    the reduce prompt stays bounded however long the document is.
+    """
+    while estimate_tokens(text) > SUMMARY_SECTION_TOKENS:
+        sections = split_summary_sections(text)
+        partials = map_bounded(
+            summary_section_executor,
+            lambda section: generate_concepts_with_gemini(section, ('low',)),
+            sections,
+            SUMMARY_MAX_WORKERS
+        )
+        reduced = join_partial_summaries([(summaries['low'], key_concepts) for summaries, key_concepts, _, _ in partials])
+        logger.info(f"Reduced {len(sections)} sections from {estimate_tokens(text)} to {estimate_tokens(reduced)} tokens")
+        if len(reduced) >= len(text):
+            break  # Not shrinking any further; summarize what we have
+        text = reduced
+    return text
+
+
+def summarize_long_with_gemini(text, levels):
+    """Map-reduce summarization: section summaries first, then one prompt over them."""
+    return generate_concepts_with_gemini(gemini_reduce_input(text), levels)
+
+
+def nltk_reduce_input(text):
+    """NLTK map step: returns (reduced_text, key_concepts).
+
+    Sections are summarized concurrently with their own frequency tables, and
+    key concepts are ranked by how many sections they appear in.
+    """
+    concept_counts = Counter()
+    first_seen = {}
+    while estimate_tokens(text) > SUMMARY_SECTION_TOKENS:
+        sections = split_summary_sections(text)
+        partials = map_bounded(
+            summary_section_executor,
+            lambda section: (generate_summaries(section, ('low',))['low'], extract_key_concepts(section)),
+            sections,
+            SUMMARY_MAX_WORKERS
+        )
+        for _, key_concepts in partials:
+            for concept in key_concepts:
+                first_seen.setdefault(concept, len(first_seen))
+                concept_counts[concept] += 1
+        reduced = ' '.join(summary for summary, _ in partials)
+        if len(reduced) >= len(text):
+            break  # Not shrinking any further; summarize what we have
+        text = reduced
+    if not concept_counts:
+        return text, extract_key_concepts(text)
+    ranked = sorted(concept_counts, key=lambda concept: (-concept_counts[concept], first_seen[concept]))
+    return text, ranked[:6]
+
+
+def build_summary_result(summary, key_concepts, focus_points, related_topics):
+    return {
+        "summary": summary,
+        "keyConcepts": key_concepts,
+        "learningEnhancement": {
+            "focusPoints": focus_points,
+            "suggestedRelatedTopics": related_topics
+        }
+    }
+
+
+GEMINI_SUMMARY_PROMPT = textwrap.dedent("""\
+    Please analyze this text and provide:
+    {summary_instructions}
+    2. 6 key concepts as brief phrases (2-5 words each).
+    3. 3 learning focus points (1 sentence each).
+    4. 4 related topics that would complement this knowledge (short phrases).
+
+    Format your response as JSON with these exact keys:
+    {keys}
+
+    Text to analyze:
+    {text}
+    """)
+
+GEMINI_SINGLE_SUMMARY_INSTRUCTIONS = textwrap.dedent("""\
+    1. A summary of the text. The summary should be concise but comprehensive.
+       Compression level "{level}": high = 1-2 sentences, medium = 3-4 sentences, low = 5-7 sentences.""")
+
+GEMINI_MULTI_SUMMARY_INSTRUCTIONS = textwrap.dedent("""\
+    1. Summaries of the text, one per compression level. Each should be concise but comprehensive.
+       high = 1-2 sentences, medium = 3-4 sentences, low = 5-7 sentences.""")
+
+
+def gemini_summary_prompt(text, levels):
+    """Build the Gemini prompt asking for summaries at the given levels plus concepts."""
+    if len(levels) == 1:
+        summary_instructions = GEMINI_SINGLE_SUMMARY_INSTRUCTIONS.format(level=levels[0])
+        keys = '"summary", "keyConcepts", "focusPoints", "relatedTopics"'
+    else:
+        summary_instructions = GEMINI_MULTI_SUMMARY_INSTRUCTIONS
+        level_keys = ", ".join(f'"{lvl}"' for lvl in levels)
+        keys = f'"summaries" (an object with the keys {level_keys}), "keyConcepts", "focusPoints", "relatedTopics"'
+    return GEMINI_SUMMARY_PROMPT.format(
+        summary_instructions=summary_instructions,
+        keys=keys,
+        text=precompress_text(text)
+    )
+
+
+def precompress_text(text, max_tokens=SUMMARY_PROMPT_TOKENS):
+    """Fit text into max_tokens by keeping its highest-scoring sentences, in order.
+
+    Uses the same sentence scoring as the NLTK summarizer; sentences over the
+    budget on their own are split at word boundaries and keep their score.
+    Text already within budget (or with SUMMARY_PRECOMPRESS off) only has
+    redundant whitespace collapsed. If scoring fails or nothing fits, the
+    tidied text is truncated to the budget instead.
+    """
+    text = re.sub(r'\n\s*\n\s*', '\n\n', re.sub(r'[ \t\r\f\v]+', ' ', text)).strip()
+    tokens_in = estimate_tokens(text)
+    if not SUMMARY_PRECOMPRESS or tokens_in <= max_tokens:
+        prompt_compression_stats['bypassed'] += 1
+        return text
+
+    try:
+        sentences, sentence_scores, error = score_sentences(text)
+    except Exception as e:
+        error = str(e)
+    if error:
+        logger.warning(f"Truncating prompt text instead of pre-compressing: {error}")
+        prompt_compression_stats['failed'] += 1
+        return truncate_to_tokens(text, max_tokens)
+
+    # (sentence index, piece index) -> piece; pieces of one sentence share its score
+    pieces = {}
+    for i in sentence_scores:
+        if estimate_tokens(sentences[i]) + 1 > max_tokens:
+            for j, piece in enumerate(split_tts_units(sentences[i], (max_tokens - 1) * SUMMARY_BYTES_PER_TOKEN)):
+                pieces[(i, j)] = piece
+        else:
+            pieces[(i, 0)] = sentences[i]
+
+    kept = []
+    used = 0
+    for unit in sorted(pieces, key=lambda unit: (-sentence_scores[unit[0]], unit)):
+        cost = estimate_tokens(pieces[unit]) + 1
+        if used + cost <= max_tokens:
+            kept.append(unit)
+            used += cost
+    if not kept:
+        logger.warning("No sentence fits the prompt budget; truncating prompt text")
+        prompt_compression_stats['failed'] += 1
+        return truncate_to_tokens(text, max_tokens)
+    kept.sort()
+    compressed = ' '.join(pieces[unit] for unit in kept)
+
+    tokens_out = estimate_tokens(compressed)
+    prompt_compression_stats['compressed'] += 1
+    prompt_compression_stats['tokensIn'] += tokens_in
+    prompt_compression_stats['tokensOut'] += tokens_out
+    logger.info(f"Pre-compressed prompt text from {tokens_in} to {tokens_out} tokens ({len(kept)}/{len(pieces)} sentences)")
+    return compressed
+
+
+def truncate_to_tokens(text, max_tokens):
+    """Cut text to about max_tokens, at a word boundary where possible."""
+    limit = max_tokens * SUMMARY_BYTES_PER_TOKEN
+    encoded = text.encode('utf-8')
+    if len(encoded) <= limit:
+        return text
+    truncated = encoded[:limit].decode('utf-8', 'ignore')
+    boundary = truncated.rfind(' ')
+    return truncated[:boundary] if boundary > 0 else truncated
+
+
+def prompt_compression_summary():
+    stats = dict(prompt_compression_stats)
+    tokens_in = stats.get('tokensIn', 0)
+    stats['ratio'] = round(stats.get('tokensOut', 0) / tokens_in, 4) if tokens_in else None
+    return stats
+
+
+def generate_concepts_with_gemini(text, levels):
+    """Use Gemini API for summarization, key concepts, and learning enhancement.
+        Several levels are requested in the same prompt. Output is constrained
+        to a JSON schema and validated strictly; invalid output gets up to
+        GEMINI_REPAIR_ATTEMPTS repair calls before giving up. Returns
+        ({level: summary}, key_concepts, focus_points, related_topics).
+    """
+    try:
+        prompt = gemini_summary_prompt(text, levels)
+        generation_config = gemini_generation_config(levels)
+        response = gemini_model.generate_content(prompt, generation_config=generation_config)
+
+        for attempt in range(GEMINI_REPAIR_ATTEMPTS + 1):
+            result, errors = parse_gemini_result(response.text, levels)
+            if not errors:
+                gemini_output_stats['repaired' if attempt else 'valid'] += 1
+                return normalize_gemini_result(result, levels)
+            logger.warning(f"Invalid JSON from Gemini (attempt {attempt + 1}): {'; '.join(errors)}")
+            if attempt < GEMINI_REPAIR_ATTEMPTS:
+                response = gemini_model.generate_content(
+                    gemini_repair_prompt(prompt, response.text, errors),
+                    generation_config=generation_config
+                )
+
+        gemini_output_stats['invalid'] += 1
+        raise ValueError(f"Gemini output failed validation: {'; '.join(errors)}")
 
     except Exception as e:
         logger.error(f"Error in generate_concepts_with_gemini: {str(e)}")
         raise  # Re-raise to trigger NLTK fallback
 
 
-def generate_summary(text, level):
-    """NLTK-based text summarization (same as before, but used as fallback)."""
+def gemini_response_schema(levels):
+    """JSON schema for the summary object requested from Gemini."""
+    string_list = {'type': 'array', 'items': {'type': 'string'}}
+    if len(levels) == 1:
+        summary_field = {'summary': {'type': 'string'}}
+    else:
+        summary_field = {'summaries': {
+            'type': 'object',
+            'properties': {lvl: {'type': 'string'} for lvl in levels},
+            'required': list(levels),
+        }}
+    properties = dict(summary_field, keyConcepts=string_list, focusPoints=string_list, relatedTopics=string_list)
+    return {'type': 'object', 'properties': properties, 'required': list(properties)}
+
+
+def gemini_generation_config(levels):
+    return {'response_mime_type': 'application/json', 'response_schema': gemini_response_schema(levels)}
+
+
+def parse_gemini_result(result_text, levels):
+    """Parse and strictly validate Gemini output; returns (result, errors)."""
     try:
-        sentences = sent_tokenize(text)
-        if not sentences:
-            logger.warning("No sentences found in text")
-            return "No content to summarize."
+        result = json.loads(result_text)
+    except ValueError as e:
+        return None, [f"not valid JSON ({str(e)})"]
+    if not isinstance(result, dict):
+        return None, ["top level is not an object"]
+
+    errors = []
+    if len(levels) == 1:
+        summaries = {levels[0]: result.get('summary')}
+    else:
+        summaries = result.get('summaries')
+        if not isinstance(summaries, dict):
+            return None, ['"summaries" must be an object']
+    for lvl in levels:
+        summary = summaries.get(lvl)
+        if not isinstance(summary, str) or not summary.strip():
+            errors.append(f'summary for level "{lvl}" must be a non-empty string')
+    for field in ('keyConcepts', 'focusPoints', 'relatedTopics'):
+        value = result.get(field)
+        if not isinstance(value, list) or not value:
+            errors.append(f'"{field}" must be a non-empty array')
+        elif not all(isinstance(item, str) and item.strip() for item in value):
+            errors.append(f'"{field}" must contain only non-empty strings')
+    return result, errors
+
+
+GEMINI_REPAIR_PROMPT = textwrap.dedent("""\
+    {prompt}
+    Your previous answer did not match the required JSON format:
+    {problems}
+
+    Previous answer:
+    {result_text}
+
+    Reply with the corrected JSON object only.
+    """)
+
+
+def gemini_repair_prompt(prompt, result_text, errors):
+    problems = '\n'.join(f"- {error}" for error in errors)
+    return GEMINI_REPAIR_PROMPT.format(prompt=prompt, problems=problems, result_text=result_text)
+
+
+def normalize_gemini_result(result, levels):
+    """Apply defaults and list limits to a parsed Gemini JSON object."""
+    summaries = result.get("summaries")
+    if not isinstance(summaries, dict):
+        summaries = {levels[0]: result.get("summary")}
+    summaries = {
+        lvl: summaries.get(lvl) or "Could not generate summary."  # Provide default
+        for lvl in levels
+    }
+    key_concepts = result.get("keyConcepts", [])[:6]
+    focus_points = result.get("focusPoints", [])[:3]
+    related_topics = result.get("relatedTopics", [])[:4]
+
+    return summaries, key_concepts, focus_points, related_topics
+
+
+class JSONFieldStream:
+    """Incrementally parse the top-level fields of a JSON object as text arrives.
+
+    feed() returns (key, value) pairs for fields whose value has completed
+    since the last call. Text before the opening brace (e.g. a ```json fence)
+    and after the closing one is ignored, and a trailing comma inside a value
+    is tolerated.
+    """
 
-        words = word_tokenize(text.lower())
-        stop_words = set(stopwords.words('english'))
-        words = [word for word in words if word.isalnum() and word not in stop_words]
-        if not words:
-             logger.warning("No significant words found after filtering")
-             return "Content lacks significant terms for summarization."
+    def __init__(self):
+        self.buffer = ''
+        self.pos = 0
+        self.depth = 0
+        self.in_string = False
+        self.escape = False
+        self.closed = False
+        self.key = None
+        self.key_start = None
+        self.value_start = None
+
+    def feed(self, text):
+        self.buffer += text
+        fields = []
+        while self.pos < len(self.buffer) and not self.closed:
+            c = self.buffer[self.pos]
+            if self.in_string:
+                if self.escape:
+                    self.escape = False
+                elif c == '\\':
+                    self.escape = True
+                elif c == '"':
+                    self.in_string = False
+                    if self.key_start is not None:
+                        self.key = self._loads(self.buffer[self.key_start:self.pos + 1])
+                        self.key_start = None
+            elif self.depth == 0:
+                if c == '{':
+                    self.depth = 1
+            elif c == '"':
+                self.in_string = True
+                if self.depth == 1 and self.key is None:
+                    self.key_start = self.pos
+            elif c in '{[':
+                self.depth += 1
+            elif c in '}]':
+                self.depth -= 1
+                if self.depth == 0:
+                    self._finish_field(fields)
+                    self.closed = True
+            elif self.depth == 1:
+                if c == ':' and self.key is not None and self.value_start is None:
+                    self.value_start = self.pos + 1
+                elif c == ',':
+                    self._finish_field(fields)
+            self.pos += 1
+        return fields
+
+    def _finish_field(self, fields):
+        if self.key is not None and self.value_start is not None:
+            raw = self.buffer[self.value_start:self.pos].strip()
+            value = self._loads(raw)
+            if value is None:
+                value = self._loads(re.sub(r',\s*([\]}])', r'\1', raw))
+            if value is not None:
+                fields.append((self.key, value))
+            else:
+                logger.warning(f"Could not parse streamed field {self.key!r}")
+        self.key = None
+        self.value_start = None
+
+    @staticmethod
+    def _loads(raw):
+        try:
+            return json.loads(raw)
+        except ValueError:
+            return None
 
-        word_freq = FreqDist(words)
 
-        sentence_scores = {}
-        for i, sentence in enumerate(sentences):
-            sentence_words = word_tokenize(sentence.lower())
-            sentence_words = [word for word in sentence_words if word.isalnum() and word not in stop_words]
-            if len(sentence_words) == 0:
-                continue
+def stream_summary_events(text, level, long_text=False):
+    """Yield SSE events for a summary as each field becomes available.
+
+    Cached results are replayed at once. Gemini output is streamed and parsed
+    field by field (for long text, only the reduce step streams); if Gemini
+    is unavailable or fails, the NLTK result fills in whatever has not been
+    sent yet.
+    """
+    levels = (level,)
+    long_text = long_text or estimate_tokens(text) > SUMMARY_MAP_REDUCE_TOKENS
+    sent = set()
+
+    def emit_result(result):
+        fields = {
+            'summary': result['summary'],
+            'keyConcepts': result['keyConcepts'],
+            'focusPoints': result['learningEnhancement']['focusPoints'],
+            'relatedTopics': result['learningEnhancement']['suggestedRelatedTopics'],
+        }
+        for name, value in fields.items():
+            if name not in sent:
+                sent.add(name)
+                yield sse_event(name, value)
+
+    engine = 'gemini' if gemini_available else 'nltk'
+    result = summary_cache.get(text, level, engine)
+    if result is not None:
+        yield from emit_result(result)
+        yield sse_event('done', {'engine': engine, 'cached': True})
+        return
+
+    if gemini_available:
+        try:
+            parser = JSONFieldStream()
+            parsed = {}
+            prompt_text = gemini_reduce_input(text) if long_text else text
+            stream = gemini_model.generate_content(
+                gemini_summary_prompt(prompt_text, levels),
+                generation_config=gemini_generation_config(levels),
+                stream=True
+            )
+            for chunk in stream:
+                for key, value in parser.feed(chunk.text):
+                    parsed[key] = value
+                    if key == 'summaries' and isinstance(value, dict):
+                        key, value = 'summary', value.get(level)
+                    if key in STREAMED_SUMMARY_FIELDS and key not in sent and value:
+                        sent.add(key)
+                        yield sse_event(key, value[:STREAMED_SUMMARY_FIELDS[key]] if isinstance(value, list) else value)
+            _, errors = parse_gemini_result(json.dumps(parsed), levels)
+            if errors:
+                gemini_output_stats['invalid'] += 1
+                raise ValueError(f"Gemini output failed validation: {'; '.join(errors)}")
+            gemini_output_stats['valid'] += 1
+            summaries, key_concepts, focus_points, related_topics = normalize_gemini_result(parsed, levels)
+            summary_cache.put(text, level, 'gemini', build_summary_result(
+                summaries[level], key_concepts, focus_points, related_topics
+            ))
+            logger.info("Streamed summary and concepts from Gemini")
+            yield sse_event('done', {'engine': 'gemini', 'cached': False})
+            return
+        except Exception as e:
+            logger.error(f"Error streaming from Gemini API: {str(e)}. Falling back to NLTK.")
+
+    result = summary_cache.get(text, level, 'nltk')
+    cached = result is not None
+    if not cached:
+        logger.info("Using NLTK for summarization and concept extraction")
+        result = summarize_with_nltk(text, levels, long_text)[level]
+        summary_cache.put(text, level, 'nltk', result)
+    yield from emit_result(result)
+    yield sse_event('done', {'engine': 'nltk', 'cached': cached})
+
+
+def sse_event(event, data):
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
 
-            score = sum(word_freq[word] for word in sentence_words) / len(sentence_words)
-            sentence_scores[i] = score
-        if not sentence_scores:
-             logger.warning("No sentences could be scored")
-             return "Unable to generate a meaningful summary."
-        if level == 'high':
-            num_sentences = max(1, int(len(sentences) * 0.2))
-        elif level == 'medium':
-            num_sentences = max(2, int(len(sentences) * 0.4))
-        else:  # low
-            num_sentences = max(3, int(len(sentences) * 0.6))
-
-        summary_indices = nlargest(num_sentences, sentence_scores, key=sentence_scores.get)
-
-        if not summary_indices:
-            logger.warning("Failed to select top sentences")
-            return "Summary generation failed."
-        summary_indices.sort()
-        summary = ' '.join([sentences[i] for i in summary_indices])
-        return summary
+
+def generate_summaries(text, levels):
+    """NLTK-based text summarization (used as fallback).
+
+    Scores sentences once and cuts a summary per compression level.
+
+    Returns {level: summary}; on failure every level gets the same message.
+    """
+    summaries = _generate_summaries(text, levels)
+    if isinstance(summaries, str):
+        return {level: summaries for level in levels}
+    return summaries
+
+
+def score_sentences(text):
+    """Score each sentence by the average document frequency of its significant words.
+
+    Returns (sentences, {index: score}, error_msg); sentences without
+    significant words are left unscored.
+    """
+    sentences = sent_tokenize(text)
+    if not sentences:
+        logger.warning("No sentences found in text")
+        return sentences, {}, "No content to summarize."
+
+    words = word_tokenize(text.lower())
+    stop_words = set(stopwords.words('english'))
+    words = [word for word in words if word.isalnum() and word not in stop_words]
+    if not words:
+         logger.warning("No significant words found after filtering")
+         return sentences, {}, "Content lacks significant terms for summarization."
+
+    word_freq = FreqDist(words)
+
+    sentence_scores = {}
+    for i, sentence in enumerate(sentences):
+        sentence_words = word_tokenize(sentence.lower())
+        sentence_words = [word for word in sentence_words if word.isalnum() and word not in stop_words]
+        if len(sentence_words) == 0:
+            continue
+
+        score = sum(word_freq[word] for word in sentence_words) / len(sentence_words)
+        sentence_scores[i] = score
+    if not sentence_scores:
+         logger.warning("No sentences could be scored")
+         return sentences, {}, "Unable to generate a meaningful summary."
+    return sentences, sentence_scores, None
+
+
+def _generate_summaries(text, levels):
+    try:
+        sentences, sentence_scores, error = score_sentences(text)
+        if error:
+            return error
+        # Rank once; each level takes a prefix of the same ranking
+        ranked = nlargest(len(sentence_scores), sentence_scores, key=sentence_scores.get)
+        summaries = {}
+        for level in levels:
+            if level == 'high':
+                num_sentences = max(1, int(len(sentences) * 0.2))
+            elif level == 'medium':
+                num_sentences = max(2, int(len(sentences) * 0.4))
+            else:  # low
+                num_sentences = max(3, int(len(sentences) * 0.6))
+
+            summary_indices = ranked[:num_sentences]
+
+            if not summary_indices:
+                logger.warning("Failed to select top sentences")
+                return "Summary generation failed."
+            summary_indices.sort()
+            summaries[level] = ' '.join([sentences[i] for i in summary_indices])
+        return summaries
     except Exception as e:
-        logger.error(f"Error in generate_summary: {str(e)}")
+        logger.error(f"Error in _generate_summaries: {str(e)}")
         return "Error generating summary."
 
 
@@ -606,7 +3373,7 @@ def generate_related_topics(text, key_concepts, num_topics=4):
 # --- Health Check Endpoint ---
 @app.route('/api/health', methods=['GET'])
 def health_check():
-    status = "ok" if client is not None else "limited"
+    status = "ok" if tts_backend is not None else "limited"
     version = "1.0.0"
 
     try:
@@ -621,19 +3388,54 @@ def health_check():
             'status': status,
             'version': version,
             'services': {
-                'tts': 'available' if client is not None else 'unavailable',
+                'tts': 'available' if tts_backend is not None else 'unavailable',
+                'ttsBackend': tts_backend.name if tts_backend is not None else None,
                 'nltk': nltk_status,
                 'gemini': 'available' if gemini_available else 'unavailable', # Add Gemini status
             },
+            'ttsCache': tts_cache.stats(),
+            'ttsSingleFlight': tts_singleflight.stats(),
+            'voiceCatalog': voice_catalog.stats(),
+            'summaryCache': summary_cache.stats(),
+            'geminiOutput': dict(gemini_output_stats),
+            'summaryJobs': summary_jobs.stats(),
+            'summaryDeadline': dict(summary_deadline_stats, seconds=SUMMARY_DEADLINE),
+            'promptCompression': prompt_compression_summary(),
             'timestamp': os.path.getmtime(__file__) if os.path.exists(__file__) else None
         })
     except Exception as e:
         logger.error(f"Error in health check: {str(e)}")
         return jsonify({'status': 'error', 'error': str(e)}), 500
 
+@app.cli.command('tts-warmup')
+@click.option('--manifest', default=None, help='Path to the warm-up manifest (defaults to TTS_WARMUP_MANIFEST).')
+def tts_warmup_command(manifest):
+    """Pre-synthesize curated practice phrases into the TTS cache."""
+    if tts_backend is None:
+        raise click.ClickException('No TTS backend available')
+    outcome = warm_tts_cache(load_warmup_manifest(manifest))
+    click.echo(
+        f"{outcome['synthesized']} synthesized, {outcome['cached']} already cached, "
+        f"{outcome['failed']} failed"
+    )
+
+
+@app.before_request
+def ensure_background_workers():
+    # Serving processes (gunicorn workers, the dev server) start workers lazily on
+    # their first request, so CLI commands never claim jobs they cannot finish
+    # and never warm the cache on their own
+    start_summary_job_workers()
+    start_tts_warmup()
+
 if __name__ == "__main__":
     port = int(os.environ.get("PORT", 5000))
     debug_mode = os.environ.get("FLASK_DEBUG", "False").lower() in ('true', '1', 't')
 
+    # Resume queued jobs and warm the cache right away, except in the reloader's watcher process
+    if not debug_mode or os.environ.get("WERKZEUG_RUN_MAIN") == "true":
+        start_summary_job_workers()
+        start_tts_warmup()
+
     logger.info(f"Starting Flask app on port {port} with debug={debug_mode}")
     app.run(host="0.0.0.0", port=port, debug=debug_mode)
\ No newline at end of file
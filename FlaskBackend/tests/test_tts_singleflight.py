@@ -0,0 +1,102 @@
+import asyncio
+import os
+import sys
+import tempfile
+import threading
+import types
+
+import pytest
+
+_tmp = tempfile.mkdtemp()
+os.environ.setdefault('TTS_CACHE_DIR', os.path.join(_tmp, 'tts_cache'))
+os.environ.setdefault('SUMMARY_CACHE_PATH', os.path.join(_tmp, 'summary_cache.sqlite3'))
+os.environ.setdefault('SUMMARY_JOBS_PATH', os.path.join(_tmp, 'summary_jobs.sqlite3'))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app as appmod  # noqa: E402
+
+
+class BlockingAsyncClient:
+    """Stub async Google client whose calls wait until release is set."""
+
+    def __init__(self):
+        self.started = threading.Event()
+        self.release = threading.Event()
+        self.calls = 0
+
+    async def synthesize_speech(self, request=None):
+        self.calls += 1
+        self.started.set()
+        while not self.release.is_set():
+            await asyncio.sleep(0.01)
+        return types.SimpleNamespace(audio_content=b'async:' + request.input.text.encode())
+
+
+class StubAsyncRunner(appmod.AsyncTTSRunner):
+    def __init__(self, stub):
+        self._stub = stub
+        super().__init__()
+
+    async def _create_client(self):
+        return self._stub
+
+
+@pytest.fixture
+def async_client(monkeypatch):
+    """TTS_ASYNC mode: get_tts_entry flights and submit_tts flights share one stub"""
+    stub = BlockingAsyncClient()
+    monkeypatch.setattr(appmod, 'tts_backend', appmod.GoogleTTSBackend())
+    runner = StubAsyncRunner(stub)
+    monkeypatch.setattr(appmod, 'get_async_tts', lambda: runner)
+    return stub
+
+
+def params_for(text):
+    params, error = appmod.parse_tts_request({'text': text})
+    assert error is None
+    return params
+
+
+def test_async_caller_joins_sync_flight(async_client):
+    params = params_for('Async caller joins a sync flight.')
+
+    leader = appmod.tts_chunk_executor.submit(appmod.get_tts_entry, params)
+    assert async_client.started.wait(5)
+    follower = appmod.submit_tts(params)
+    async_client.release.set()
+
+    audio, _, cached = leader.result(5)
+    assert cached is False
+    assert follower.result(5) == (audio, True)
+    assert async_client.calls == 1
+
+
+def test_sync_caller_joins_async_flight(async_client):
+    params = params_for('Sync caller joins an async flight.')
+
+    leader = appmod.submit_tts(params)
+    assert async_client.started.wait(5)
+    follower = appmod.tts_chunk_executor.submit(appmod.get_tts_entry, params)
+    async_client.release.set()
+
+    audio, cached = leader.result(5)
+    assert cached is False
+    follower_audio, meta, follower_cached = follower.result(5)
+    assert follower_audio == audio and follower_cached is True
+    assert meta['etag'] == appmod.audio_etag(audio)
+    assert async_client.calls == 1
+
+
+def test_sync_callers_share_the_async_in_flight_bound(async_client, monkeypatch):
+    monkeypatch.setattr(appmod, 'TTS_ASYNC_MAX_IN_FLIGHT', 1)
+    first = appmod.tts_chunk_executor.submit(appmod.synthesize_with_google, params_for('First bounded call.'))
+    assert async_client.started.wait(5)
+    second = appmod.tts_chunk_executor.submit(appmod.synthesize_with_google, params_for('Second bounded call.'))
+    with pytest.raises(TimeoutError):
+        second.result(0.2)
+    assert async_client.calls == 1
+    async_client.release.set()
+
+    assert first.result(5)[0] == b'async:First bounded call.'
+    assert second.result(5)[0] == b'async:Second bounded call.'
+    assert async_client.calls == 2
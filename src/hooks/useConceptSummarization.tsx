@@ -15,6 +15,8 @@ export const useConceptSummarization = () => {
     suggestedRelatedTopics: []
   });
   const [compressionLevel, setCompressionLevel] = useState<CompressionLevel>('medium');
+  const [summaries, setSummaries] = useState<Partial<Record<CompressionLevel, string>>>({});
+  const [summarizedText, setSummarizedText] = useState("");
   const [isProcessing, setIsProcessing] = useState(false);
   const [isGenerated, setIsGenerated] = useState(false);
   const { toast } = useToast();
@@ -34,6 +36,8 @@ export const useConceptSummarization = () => {
     try {
       const result = await summarizeConcept(inputText, compressionLevel);
       setSummary(result.summary);
+      setSummaries(result.summaries ?? {});
+      setSummarizedText(inputText);
       setKeyConcepts(result.keyConcepts);
       setLearningEnhancement(result.learningEnhancement);
       setIsGenerated(true);
@@ -56,8 +60,10 @@ export const useConceptSummarization = () => {
   const changeCompressionLevel = (level: CompressionLevel) => {
     setCompressionLevel(level);
     
-    // If summary already exists, regenerate with new compression level
-    if (isGenerated) {
+    // All levels come back together, so switching is usually local
+    if (isGenerated && summaries[level] && summarizedText === inputText) {
+      setSummary(summaries[level]);
+    } else if (isGenerated) {
       generateSummary();
     }
   };
@@ -65,6 +71,7 @@ export const useConceptSummarization = () => {
   const resetSummary = () => {
     setIsGenerated(false);
     setSummary("");
+    setSummaries({});
     setKeyConcepts([]);
     setLearningEnhancement({
       focusPoints: [],
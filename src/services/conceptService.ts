@@ -6,6 +6,8 @@ export interface SummarizedConcept {
     focusPoints: string[];
     suggestedRelatedTopics: string[];
   };
+  // Summaries for every compression level, present when requested with allLevels
+  summaries?: Record<CompressionLevel, string>;
 }
 
 // Compression levels
@@ -33,7 +35,8 @@ export const summarizeConcept = (text: string, level: CompressionLevel): Promise
       },
       body: JSON.stringify({
         text,
-        level
+        level,
+        allLevels: true
       })
     })
     .then(response => {